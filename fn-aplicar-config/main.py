@@ -1,11 +1,16 @@
 import ast
+import base64
+import hashlib
 import io
 import json
 import os
 import re
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from typing import Dict, Tuple, List
 
 import requests
+from google.api_core.exceptions import PreconditionFailed
 from google.cloud import storage, secretmanager
 import functions_framework
 
@@ -17,6 +22,9 @@ GITHUB_ACCEPT = "application/vnd.github+json"
 
 API_CONTENTS = "https://api.github.com/repos/{owner}/{repo}/contents/{path}"
 
+# Archivos procesados en paralelo (tope = pool HTTP de storage.Client)
+APPLY_MAX_WORKERS = min(int(os.getenv("APPLY_MAX_WORKERS", "8")), 10)
+
 # Variables permitidas (coinciden con tu script)
 VARIABLES_PERMITIDAS = {
     "nombre_proceso",
@@ -97,18 +105,56 @@ def _read_config_from_gcs(bucket: storage.Bucket, prefix: str, filename: str = "
         raise ValueError("No se encontraron variables válidas en config.py (GCS)")
     return cfg
 
-def _apply_config_text(text: str, cfg: Dict[str, str]) -> str:
-    # Reemplaza {{ var }} o {{var}}
-    out = text
-    for k, v in cfg.items():
-        pattern = re.compile(r"\{\{\s*" + re.escape(k) + r"\s*\}\}")
-        out = pattern.sub(v, out)
-    return out
+@lru_cache(maxsize=32)
+def _placeholder_pattern(keys: Tuple[str, ...]) -> "re.Pattern":
+    # Un solo patrón por conjunto de variables: grupo 1 = variable conocida,
+    # grupo 2 = cualquier otro {{ identificador }} (queda sin resolver)
+    known = "|".join(re.escape(k) for k in sorted(keys, key=len, reverse=True))
+    return re.compile(r"\{\{\s*(?:(" + (known or "(?!)") + r")|([A-Za-z_][\w.]*))\s*\}\}")
+
+def _apply_config_text(text: str, cfg: Dict[str, str]) -> Tuple[str, List[str]]:
+    """Reemplaza {{ var }} o {{var}} en una sola pasada.
+
+    Retorna (texto, placeholders sin resolver); los no resueltos se dejan tal cual.
+    """
+    pattern = _placeholder_pattern(tuple(sorted(cfg)))
+    unresolved = set()
+
+    def _sub(m: "re.Match") -> str:
+        if m.group(1) is not None:
+            return cfg[m.group(1)]
+        unresolved.add(m.group(2))
+        return m.group(0)
+
+    return pattern.sub(_sub, text), sorted(unresolved)
 
-def _list_objects(bucket: storage.Bucket, prefix: str, exts=(".sql", ".json")) -> List[str]:
-    return [b.name for b in bucket.list_blobs(prefix=prefix)
+def _list_objects(bucket: storage.Bucket, prefix: str, exts=(".sql", ".json")) -> List[storage.Blob]:
+    return [b for b in bucket.list_blobs(prefix=prefix)
             if os.path.splitext(b.name)[1].lower() in exts]
 
+def _md5_b64(data: bytes) -> str:
+    # Mismo formato que blob.md5_hash
+    return base64.b64encode(hashlib.md5(data).digest()).decode("ascii")
+
+def _process_object(blob: storage.Blob, cfg: Dict[str, str]) -> dict:
+    """Descarga, renderiza y sube un archivo; todo condicionado a la generation listada.
+
+    Si el contenido renderizado tiene el mismo md5 que el objeto actual no se sube. Si otro
+    proceso modificó el objeto entre el listado y la subida, GCS rechaza la escritura
+    (PreconditionFailed) en vez de pisar el cambio.
+    """
+    name = os.path.basename(blob.name)
+    src = blob.download_as_bytes(if_generation_match=blob.generation).decode("utf-8")
+    dst, pendientes = _apply_config_text(src, cfg)
+    data = dst.encode("utf-8")
+    result = {"file": name, "unresolved": pendientes, "uploaded": False}
+    if _md5_b64(data) != blob.md5_hash:
+        blob.upload_from_file(io.BytesIO(data), rewind=True, size=len(data),
+                              content_type="application/sql" if blob.name.endswith(".sql") else "application/json",
+                              if_generation_match=blob.generation)
+        result["uploaded"] = True
+    return result
+
 # ========= HTTP entry =========
 @functions_framework.http
 def apply_config(request):
@@ -136,26 +182,44 @@ def apply_config(request):
             return (json.dumps({"error": "Falta process_repo (o envía config_from_gcs=true)"}), 400)
         cfg = _read_config_from_github(process_repo)
 
-    # Aplica sobre cada .sql/.json
+    # Aplica sobre cada .sql/.json, en paralelo
     updated = []
+    unchanged = []
     errors = []
-    for obj in _list_objects(bucket, target_prefix):
+    unresolved = {}
+    blobs = _list_objects(bucket, target_prefix)
+
+    def _safe_process(blob: storage.Blob) -> dict:
         try:
-            blob = bucket.blob(obj)
-            src = blob.download_as_text(encoding="utf-8")
-            dst = _apply_config_text(src, cfg)
-            if dst != src:
-                # sobrescribe
-                bio = io.BytesIO(dst.encode("utf-8"))
-                blob.upload_from_file(bio, rewind=True,
-                                      content_type="application/sql" if obj.endswith(".sql") else "application/json")
-            updated.append(os.path.basename(obj))
+            return _process_object(blob, cfg)
+        except PreconditionFailed:
+            return {"file": os.path.basename(blob.name),
+                    "error": "El objeto fue modificado por otro proceso durante la ejecución; no se sobrescribió"}
         except Exception as e:
-            errors.append({"file": os.path.basename(obj), "error": str(e)})
+            return {"file": os.path.basename(blob.name), "error": str(e)}
+
+    if blobs:
+        with ThreadPoolExecutor(max_workers=min(APPLY_MAX_WORKERS, len(blobs))) as executor:
+            resultados = list(executor.map(_safe_process, blobs))
+    else:
+        resultados = []
+
+    for r in resultados:
+        if "error" in r:
+            errors.append(r)
+            continue
+        if r["unresolved"]:
+            unresolved[r["file"]] = r["unresolved"]
+            print(f"⚠️ {r['file']}: placeholders sin resolver {r['unresolved']}")
+        updated.append(r["file"])
+        if not r["uploaded"]:
+            unchanged.append(r["file"])
 
     return (json.dumps({
         "status": "ok" if not errors else "partial",
         "gcs_prefix": f"gs://{bucket_name}/{target_prefix}",
         "updated_files": updated,
+        "unchanged_files": unchanged,
+        "unresolved": unresolved,
         "errors": errors
     }), 200 if not errors else 207)
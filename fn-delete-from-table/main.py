@@ -2,6 +2,8 @@ import functions_framework
 import json
 from google.cloud import bigquery
 
+from config_resolver import resolve_params
+
 bq_client = bigquery.Client()
 PROJECT_ID = "deinsoluciones-serverless"
 
@@ -16,30 +18,7 @@ def eliminar_por_fecha(request):
         if not process_name or not process_fn_name:
             return json.dumps({"error": "Faltan 'process_name' , 'process_fn_name' o 'arquetype_name' ."}), 400
 
-        param_query = f"""
-            SELECT params
-            FROM `{PROJECT_ID}.dev_config_zone.process_params`
-            WHERE process_name = @process_name
-            AND process_fn_name = @process_fn_name
-            AND arquetype_name = @arquetype_name
-            AND active = TRUE
-        """
-        job_config = bigquery.QueryJobConfig(
-            query_parameters=[
-                bigquery.ScalarQueryParameter("process_name", "STRING", process_name),
-                bigquery.ScalarQueryParameter("process_fn_name", "STRING", process_fn_name),
-                bigquery.ScalarQueryParameter("arquetype_name", "STRING", arquetype_name)
-            ]
-        )
-        result_iterator = bq_client.query(param_query, job_config=job_config).result()
-
-        param_list = []
-        for row in result_iterator:
-            row_params = row.get("params")
-            if isinstance(row_params, list):
-                param_list.extend(row_params)
-            elif row_params:
-                param_list.append(row_params)
+        param_list = resolve_params(process_name, process_fn_name, arquetype_name, client=bq_client)
 
         if not param_list:
             return json.dumps({"error": "No se encontraron parámetros válidos."}), 404
@@ -0,0 +1,358 @@
+"""Transformación opcional de los archivos descargados antes de dejarlos en GCS.
+
+Los partners envían .csv.gz y .zip que después se cargan como CSV plano. Esta etapa
+descomprime gzip/zip en streaming y, si se pide, transcodifica el CSV a Parquet
+(Snappy o ZSTD) leyendo bloques de tamaño fijo con el lector CSV de pyarrow, así la
+memoria no crece con el tamaño del archivo y la copia en GCS queda columnar.
+
+Parámetros de la entrada de process_params:
+    decompress          none | auto | gzip | zip (auto detecta por firma del archivo)
+    transcode           parquet (vacío = no transcodifica)
+    parquet_compression snappy | zstd (default snappy)
+    batch_size_mb       tamaño de bloque CSV leído por batch / row group (default 64)
+    csv_delimiter, csv_encoding, csv_column_types ({"columna": "string", ...})
+
+También contiene la subida en streaming (stream_to_gcs / land_to_gcs) que usan las
+funciones de descarga, con o sin transformación. Los .zip se leen por rangos de bytes
+(read_range) en vez de copiarse a /tmp, que en Cloud Run ocupa memoria.
+
+Este archivo se copia tal cual en cada función que lo usa (cada carpeta se
+despliega por separado con --source).
+"""
+import gzip
+import io
+import os
+import posixpath
+import queue
+import shutil
+import tempfile
+import threading
+import zipfile
+from typing import List, Optional
+
+import pyarrow as pa
+import pyarrow.csv as pv
+import pyarrow.parquet as pq
+
+# Tamaño de chunk del upload resumable (múltiplo de 256 KiB) y chunks en vuelo entre descarga y subida
+STREAM_CHUNK_SIZE = int(os.getenv("STREAM_CHUNK_SIZE", str(8 * 1024 * 1024)))
+STREAM_QUEUE_DEPTH = int(os.getenv("STREAM_QUEUE_DEPTH", "4"))
+_FIN_STREAM = object()
+TRANSFORM_CHUNK_SIZE = int(os.getenv("TRANSFORM_CHUNK_SIZE", str(8 * 1024 * 1024)))
+DEFAULT_BATCH_SIZE_MB = float(os.getenv("TRANSCODE_BATCH_SIZE_MB", "64"))
+PARQUET_COMPRESSIONS = {"snappy", "zstd"}
+CSV_EXTENSIONS = (".csv", ".txt", ".tsv")
+GZIP_MAGIC = b"\x1f\x8b"
+ZIP_MAGIC = b"PK\x03\x04"
+# Metadata del objeto GCS que describe la transformación aplicada
+TRANSFORM_METADATA = "transform"
+
+
+class ChunkStream(io.RawIOBase):
+    """Adapta un read_chunk() (b"" al terminar) a un archivo binario de solo lectura."""
+
+    def __init__(self, read_chunk):
+        self._read_chunk = read_chunk
+        self._buffer = memoryview(b"")
+        self.bytes_read = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._buffer:
+            data = self._read_chunk()
+            if not data:
+                return 0
+            self.bytes_read += len(data)
+            self._buffer = memoryview(data)
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        return n
+
+
+def chunk_reader(read_chunk) -> io.BufferedReader:
+    return io.BufferedReader(ChunkStream(read_chunk), buffer_size=TRANSFORM_CHUNK_SIZE)
+
+
+class RangeStream(io.RawIOBase):
+    """Archivo seekable de solo lectura sobre read_range(offset, length) -> bytes.
+
+    Cada lectura es un pedido por rango al origen (GET con Range en S3, download_blob con
+    offset/length en Azure, seek + read en SFTP).
+    """
+
+    def __init__(self, read_range, size):
+        self._read_range = read_range
+        self._size = size
+        self._pos = 0
+        self.bytes_read = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self._size
+        if offset < 0:
+            raise ValueError(f"posición negativa: {offset}")
+        self._pos = offset
+        return self._pos
+
+    def readinto(self, b):
+        n = min(len(b), self._size - self._pos)
+        if n <= 0:
+            return 0
+        data = self._read_range(self._pos, n)
+        if len(data) != n:
+            raise IOError(f"rango incompleto en {self._pos}: se esperaban {n} bytes y llegaron {len(data)}")
+        b[:n] = data
+        self._pos += n
+        self.bytes_read += n
+        return n
+
+
+def range_reader(read_range, size) -> io.BufferedReader:
+    return io.BufferedReader(RangeStream(read_range, size), buffer_size=TRANSFORM_CHUNK_SIZE)
+
+
+def transform_options(params) -> Optional[dict]:
+    """Lee la configuración de transformación de la entrada; None si no se pidió ninguna."""
+    transcode = (params.get("transcode") or "").strip().lower() or None
+    decompress = str(params.get("decompress") or ("auto" if transcode else "none")).strip().lower()
+    decompress = {"true": "auto", "1": "auto", "false": "none", "0": "none"}.get(decompress, decompress)
+    if decompress not in {"none", "auto", "gzip", "zip"}:
+        raise ValueError(f"decompress no soportado: {decompress}")
+    if transcode not in {None, "parquet"}:
+        raise ValueError(f"transcode no soportado: {transcode}")
+    if decompress == "none" and not transcode:
+        return None
+
+    compression = (params.get("parquet_compression") or "snappy").strip().lower()
+    if compression not in PARQUET_COMPRESSIONS:
+        raise ValueError(f"parquet_compression no soportado: {compression}")
+    batch_size_mb = float(params.get("batch_size_mb") or DEFAULT_BATCH_SIZE_MB)
+    return {
+        "decompress": decompress,
+        "transcode": transcode,
+        "parquet_compression": compression,
+        "batch_size": max(int(batch_size_mb * 1024 * 1024), 1024 * 1024),
+        "csv_delimiter": params.get("csv_delimiter") or ",",
+        "csv_encoding": params.get("csv_encoding") or "utf8",
+        "csv_column_types": params.get("csv_column_types") or {},
+    }
+
+
+def detect_compression(source, name: str, decompress: str) -> Optional[str]:
+    """Retorna "gzip", "zip" o None según la configuración, la firma y la extensión."""
+    if decompress in ("gzip", "zip"):
+        return decompress
+    if decompress == "none":
+        return None
+    firma = source.peek(4)[:4] if hasattr(source, "peek") else b""
+    if firma.startswith(GZIP_MAGIC):
+        return "gzip"
+    if firma.startswith(ZIP_MAGIC):
+        return "zip"
+    lower = name.lower()
+    if lower.endswith((".gz", ".gzip")):
+        return "gzip"
+    if lower.endswith(".zip"):
+        return "zip"
+    return None
+
+
+def output_name(name: str, compression: Optional[str], transcode: Optional[str]) -> str:
+    """Nombre del objeto resultante: sin .gz y con .parquet si se transcodifica."""
+    if compression == "gzip":
+        for ext in (".gz", ".gzip"):
+            if name.lower().endswith(ext):
+                name = name[: -len(ext)]
+                break
+    if transcode == "parquet":
+        root, ext = posixpath.splitext(name)
+        if ext.lower() in CSV_EXTENSIONS:
+            name = root
+        name = f"{name}.parquet"
+    return name
+
+
+def planned_output_name(name: str, options: Optional[dict]) -> Optional[str]:
+    """Nombre de salida previsible antes de descargar (None si depende del contenido, ej. un zip)."""
+    if not options:
+        return name
+    lower = name.lower()
+    auto = options["decompress"] == "auto"
+    if options["decompress"] == "zip" or (auto and lower.endswith(".zip")):
+        return None
+    gzip_ = options["decompress"] == "gzip" or (auto and lower.endswith((".gz", ".gzip")))
+    return output_name(name, "gzip" if gzip_ else None, options["transcode"])
+
+
+def _csv_to_parquet(stream, writer, options) -> int:
+    column_types = {col: pa.type_for_alias(tipo) for col, tipo in options["csv_column_types"].items()}
+    reader = pv.open_csv(
+        stream,
+        read_options=pv.ReadOptions(block_size=options["batch_size"], encoding=options["csv_encoding"]),
+        parse_options=pv.ParseOptions(delimiter=options["csv_delimiter"]),
+        convert_options=pv.ConvertOptions(column_types=column_types),
+    )
+    rows = 0
+    # Cada bloque CSV se escribe como un row group; el esquema se infiere del primer bloque
+    with pq.ParquetWriter(writer, reader.schema, compression=options["parquet_compression"]) as parquet_writer:
+        for batch in reader:
+            parquet_writer.write_batch(batch)
+            rows += batch.num_rows
+    return rows
+
+
+def _write_output(stream, out_blob, options, metadata, descripcion) -> dict:
+    out_blob.metadata = {**metadata, TRANSFORM_METADATA: descripcion}
+    resultado = {"gcs_path": f"gs://{out_blob.bucket.name}/{out_blob.name}"}
+    with out_blob.open("wb", chunk_size=TRANSFORM_CHUNK_SIZE, ignore_flush=True) as writer:
+        if options["transcode"] == "parquet":
+            resultado["rows"] = _csv_to_parquet(stream, writer, options)
+        else:
+            shutil.copyfileobj(stream, writer, TRANSFORM_CHUNK_SIZE)
+        resultado["bytes"] = writer.tell()
+    return resultado
+
+
+def transform_to_gcs(source, blob, options, ranged=None) -> dict:
+    """Descomprime/transcodifica `source` (archivo binario) y sube el resultado junto a `blob`.
+
+    `blob` es el destino que tendría el archivo sin transformar: de él se toman el bucket,
+    la carpeta y la metadata de origen. `ranged` (opcional) crea un lector seekable por
+    rangos del mismo origen, que se usa si resulta ser un zip y `source` no es seekable.
+    Retorna la compresión detectada y las salidas escritas.
+    """
+    compression = detect_compression(source, blob.name, options["decompress"])
+    metadata = dict(blob.metadata or {})
+    pasos = [compression] if compression else []
+    if options["transcode"]:
+        pasos.append(f"{options['transcode']}:{options['parquet_compression']}")
+    descripcion = "+".join(pasos) or "none"
+    outputs = []
+
+    if compression == "zip":
+        # El índice de un zip está al final del archivo: si el origen no es seekable se lee
+        # por rangos; solo sin esa opción se copia a un temporal. Cada miembro se
+        # descomprime en streaming
+        seekable = hasattr(source, "seekable") and source.seekable()
+        if not seekable and ranged is not None:
+            source, seekable = ranged(), True
+        spool = None
+        if not seekable:
+            spool = tempfile.TemporaryFile()
+            shutil.copyfileobj(source, spool, TRANSFORM_CHUNK_SIZE)
+            spool.seek(0)
+        try:
+            with zipfile.ZipFile(spool or source) as zf:
+                carpeta = posixpath.dirname(blob.name)
+                for info in zf.infolist():
+                    if info.is_dir():
+                        continue
+                    nombre = posixpath.join(carpeta, posixpath.basename(info.filename))
+                    out_blob = blob.bucket.blob(output_name(nombre, None, options["transcode"]))
+                    with zf.open(info) as member:
+                        outputs.append({
+                            "member": info.filename,
+                            **_write_output(member, out_blob, options, metadata, descripcion),
+                        })
+        finally:
+            if spool is not None:
+                spool.close()
+    else:
+        stream = gzip.GzipFile(fileobj=source, mode="rb") if compression == "gzip" else source
+        out_blob = blob.bucket.blob(output_name(blob.name, compression, options["transcode"]))
+        outputs.append(_write_output(stream, out_blob, options, metadata, descripcion))
+
+    return {"compression": compression, "transform": descripcion, "outputs": outputs}
+
+
+def written_paths(result: dict) -> List[str]:
+    """gs:// de los objetos que escribió transform_to_gcs (vacío si no hubo transformación)."""
+    return [output["gcs_path"] for output in result.get("outputs", [])]
+
+
+def stream_to_gcs(read_chunk, blob, chunk_size=STREAM_CHUNK_SIZE, queue_depth=STREAM_QUEUE_DEPTH):
+    """Envía los bytes de read_chunk() (b"" al terminar) a un upload resumable de GCS.
+
+    La lectura corre en otro hilo y entrega chunks por una cola acotada, así la descarga
+    y la subida se solapan y la memoria queda en ~(queue_depth + 2) * chunk_size.
+    Si algo falla, el upload resumable se cancela y no queda un objeto parcial en GCS.
+    """
+    cola = queue.Queue(maxsize=queue_depth)
+    detener = threading.Event()
+    errores = []
+
+    def _put(item):
+        while not detener.is_set():
+            try:
+                cola.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def productor():
+        try:
+            while not detener.is_set():
+                data = read_chunk()
+                if not data:
+                    break
+                _put(data)
+        except Exception as e:
+            errores.append(e)
+        finally:
+            _put(_FIN_STREAM)
+
+    hilo = threading.Thread(target=productor, daemon=True)
+    hilo.start()
+    total = 0
+    try:
+        with blob.open("wb", chunk_size=chunk_size, ignore_flush=True) as writer:
+            while True:
+                data = cola.get()
+                if data is _FIN_STREAM:
+                    break
+                writer.write(data)
+                total += len(data)
+            if errores:
+                raise errores[0]
+    finally:
+        detener.set()
+        hilo.join()
+    return total
+
+
+def land_to_gcs(read_chunk, blob, transform=None, read_range=None, size=None):
+    """Sube los chunks tal cual o pasando por la etapa de transformación.
+
+    Con read_range(offset, length) y size, un zip se lee por rangos en vez de copiarse
+    entero a un temporal; si el nombre ya indica zip no se lee nada por read_chunk.
+    Retorna (bytes leídos del origen, detalle de la transformación o {}).
+    """
+    if not transform:
+        return stream_to_gcs(read_chunk, blob), {}
+    lectores = []
+
+    def ranged():
+        lectores.append(range_reader(read_range, size))
+        return lectores[-1]
+
+    if read_range is not None and planned_output_name(blob.name, transform) is None:
+        source = ranged()
+    else:
+        source = chunk_reader(read_chunk)
+        lectores.append(source)
+    resultado = transform_to_gcs(source, blob, transform, ranged if read_range is not None else None)
+    return sum(lector.raw.bytes_read for lector in lectores), resultado
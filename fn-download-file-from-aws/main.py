@@ -2,10 +2,37 @@ import functions_framework
 import boto3
 import os
 import json
+import base64
 import tempfile
-from google.cloud import storage, secretmanager, bigquery
+from google.cloud import storage, secretmanager
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+from config_resolver import resolve_params
+from landing_transform import (
+    STREAM_CHUNK_SIZE, land_to_gcs, planned_output_name, transform_options, transform_to_gcs, written_paths,
+)
+from watermark_store import load_watermark, save_watermark
+
+TRANSFER_MODE_STREAM = "stream"
+TRANSFER_MODE_TEMPFILE = "tempfile"
+TRANSFER_MODE_MULTIPART = "multipart"
+# Descarga por rangos en paralelo para objetos grandes (configurable por entrada de process_params)
+DEFAULT_MULTIPART_THRESHOLD_MB = float(os.getenv("MULTIPART_THRESHOLD_MB", "256"))
+DEFAULT_PART_SIZE_MB = float(os.getenv("MULTIPART_PART_SIZE_MB", "32"))
+DEFAULT_MULTIPART_CONCURRENCY = int(os.getenv("MULTIPART_CONCURRENCY", "8"))
+MIN_PART_SIZE = 5 * 1024 * 1024
+S3_MAX_POOL_CONNECTIONS = 32
+WATERMARK_SOURCE = "s3"
+# Metadata del objeto GCS que identifica el origen copiado
+SOURCE_ETAG_METADATA = "source_etag"
+SOURCE_URI_METADATA = "source_uri"
+
 def get_aws_credentials():
     client = secretmanager.SecretManagerServiceClient()
     secret_name = "projects/182035274443/secrets/aws-secret-key/versions/latest"
@@ -13,76 +40,196 @@ def get_aws_credentials():
     payload = json.loads(response.payload.data.decode("UTF-8"))
     return payload["aws_access_key_id"], payload["aws_secret_access_key"]
 
-def find_most_recent_file(s3_client, bucket, prefix, partial_file_name):
+def _to_bool(val, default=False):
+    if val is None:
+        return default
+    if isinstance(val, bool):
+        return val
+    if isinstance(val, (int, float)):
+        return val != 0
+    if isinstance(val, str):
+        return val.strip().lower() in {"true", "1", "t", "yes", "y", "si", "sí"}
+    return default
+
+def find_most_recent_file(s3_client, bucket, prefix, partial_file_name, watermark=None):
+    """Retorna (key, last_modified, última key listada) del archivo más reciente que contiene partial_file_name.
+
+    Con watermark, lista solo las keys posteriores a la última listada (StartAfter), lo que
+    asume keys crecientes en orden lexicográfico (p.ej. con fecha en el nombre). Si no hay keys
+    nuevas, el más reciente sigue siendo el del watermark.
+    """
     paginator = s3_client.get_paginator("list_objects_v2")
-    page_iterator = paginator.paginate(Bucket=bucket, Prefix=prefix)
+    paginate_kwargs = {"Bucket": bucket, "Prefix": prefix}
+    if watermark:
+        paginate_kwargs["StartAfter"] = watermark.get("start_after") or watermark["last_key"]
+    page_iterator = paginator.paginate(**paginate_kwargs)
 
     candidates = []
+    last_listed = paginate_kwargs.get("StartAfter")
     for page in page_iterator:
         for obj in page.get("Contents", []):
             key = obj["Key"]
+            last_listed = key
             if partial_file_name in key:
                 candidates.append((key, obj["LastModified"]))
 
+    if not candidates and watermark:
+        head = s3_client.head_object(Bucket=bucket, Key=watermark["last_key"])
+        return watermark["last_key"], head["LastModified"], last_listed
+
     if not candidates:
         raise FileNotFoundError(f"No se encontró ningún archivo con '{partial_file_name}' en '{prefix}'")
 
-    return max(candidates, key=lambda x: x[1])[0]
-
-def upload_to_gcs(local_path, gcs_path):
-    bucket_name, *blob_parts = gcs_path.replace("gs://", "").split("/", 1)
-    blob_name = blob_parts[0] if blob_parts else os.path.basename(local_path)
-
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(blob_name)
-    blob.upload_from_filename(local_path)
-
-def get_params_from_bigquery(process_name, process_fn_name, arquetype_name):
-    client = bigquery.Client()
-    query = f"""
-        SELECT params
-        FROM `dev_config_zone.process_params`
-        WHERE process_name = @process_name
-        AND process_fn_name = @process_fn_name
-        AND arquetype_name = @arquetype_name
-        AND active = TRUE
+    key, last_modified = max(candidates, key=lambda x: x[1])
+    return key, last_modified, last_listed
+
+def watermark_source_id(bucket, prefix, partial_file_name):
+    return f"s3://{bucket}/{prefix}|{partial_file_name}"
+
+def discover_most_recent_file(s3_client, storage_client, bucket, prefix, partial_file_name, incremental):
+    """Busca el archivo más reciente usando el watermark si está habilitado.
+
+    Retorna (key, last_modified, última key listada, tipo de listado).
     """
-    job_config = bigquery.QueryJobConfig(
-        query_parameters=[
-            bigquery.ScalarQueryParameter("process_name", "STRING", process_name),
-            bigquery.ScalarQueryParameter("process_fn_name", "STRING", process_fn_name),
-            bigquery.ScalarQueryParameter("arquetype_name", "STRING", arquetype_name),
-        ]
-    )
-
-    results = client.query(query, job_config=job_config).result()
-    param_list = []
-
-    for row in results:
-        param_value = row["params"]
-        print(f"[DEBUG] Valor de params desde BQ: {param_value} — Tipo: {type(param_value)}")
-
-        try:
-            if isinstance(param_value, dict):
-                param_list.append(param_value)
-            elif isinstance(param_value, list):
-                param_list.extend(param_value)
-            elif isinstance(param_value, str):
-                loaded = json.loads(param_value)
-                if isinstance(loaded, list):
-                    param_list.extend(loaded)
-                elif isinstance(loaded, dict):
-                    param_list.append(loaded)
-                else:
-                    print(f"[WARNING] Estructura inesperada tras json.loads: {type(loaded)}")
-            else:
-                print(f"[WARNING] Tipo no manejado: {type(param_value)}")
+    if incremental:
+        source_id = watermark_source_id(bucket, prefix, partial_file_name)
+        watermark = load_watermark(storage_client, WATERMARK_SOURCE, source_id)
+        if watermark and watermark.get("last_key"):
+            try:
+                found = find_most_recent_file(s3_client, bucket, prefix, partial_file_name, watermark)
+                return (*found, "incremental")
+            except ClientError as e:
+                print(f"[WARNING] Watermark inválido para {source_id} ({e}); se usa listado completo")
+    return (*find_most_recent_file(s3_client, bucket, prefix, partial_file_name), "full")
+
+def gcs_blob(storage_client, gcs_path):
+    bucket_name, blob_name = gcs_path.replace("gs://", "").split("/", 1)
+    return storage_client.bucket(bucket_name).blob(blob_name)
+
+def multipart_options(params):
+    """Lee de la entrada de process_params el umbral, tamaño de parte y concurrencia del modo multiparte."""
+    threshold_mb = float(params.get("multipart_threshold_mb", DEFAULT_MULTIPART_THRESHOLD_MB))
+    part_size_mb = float(params.get("part_size_mb", DEFAULT_PART_SIZE_MB))
+    concurrency = int(params.get("max_concurrency", DEFAULT_MULTIPART_CONCURRENCY))
+    return {
+        "threshold": int(threshold_mb * 1024 * 1024),
+        "part_size": max(int(part_size_mb * 1024 * 1024), MIN_PART_SIZE),
+        "concurrency": max(1, min(concurrency, S3_MAX_POOL_CONNECTIONS)),
+    }
+
+def range_fetcher(s3, bucket_name, key, etag):
+    """Retorna read_range(offset, length) que pide ese rango del objeto (GET con Range e IfMatch)."""
+    def read_range(offset, length):
+        resp = s3.get_object(Bucket=bucket_name, Key=key, IfMatch=etag, Range=f"bytes={offset}-{offset + length - 1}")
+        return resp["Body"].read()
+
+    return read_range
+
+def ranged_reader(s3, bucket_name, key, size, etag, part_size, executor, concurrency):
+    """Retorna read_chunk() que entrega las partes del objeto en orden.
 
-        except Exception as e:
-            print(f"[ERROR] Falló parseo de param_value: {e}")
+    Mantiene hasta `concurrency` rangos descargándose en paralelo. Cada GET usa IfMatch con el
+    ETag, así un objeto reemplazado a mitad de la copia hace fallar la transferencia en vez de
+    mezclar versiones.
+    """
+    rangos = iter((inicio, min(part_size, size - inicio)) for inicio in range(0, size, part_size))
+    pendientes = deque()
+    read_range = range_fetcher(s3, bucket_name, key, etag)
+
+    def fetch(rango):
+        return read_range(*rango)
+
+    def llenar():
+        while len(pendientes) < concurrency:
+            rango = next(rangos, None)
+            if rango is None:
+                return
+            pendientes.append(executor.submit(fetch, rango))
+
+    def read_chunk():
+        llenar()
+        if not pendientes:
+            return b""
+        data = pendientes.popleft().result()
+        llenar()
+        return data
+
+    return read_chunk
+
+def is_already_transferred(blob, size, etag):
+    """Indica si el objeto GCS existente es idéntico al origen S3 (tamaño + ETag o MD5).
+
+    Con size=None (salida transformada, cuyo tamaño no coincide con el origen) solo se compara el ETag.
+    """
+    if blob is None or (size is not None and blob.size != size):
+        return False
+    etag = etag.strip('"')
+    if (blob.metadata or {}).get(SOURCE_ETAG_METADATA) == etag:
+        return True
+    # Un ETag de S3 sin "-" (objeto no multipart, sin SSE-KMS) es el MD5 del contenido
+    if "-" not in etag and blob.md5_hash:
+        return base64.b64decode(blob.md5_hash).hex() == etag
+    return False
 
-    return param_list
+def transfer_s3_to_gcs(s3, bucket_name, key, blob, mode=TRANSFER_MODE_STREAM, multipart=None, head=None,
+                       transform=None):
+    """Copia un objeto de S3 a GCS y retorna métricas de la transferencia.
+
+    El ETag de origen queda como metadata del objeto GCS para poder detectar reintentos.
+    """
+    start = time.monotonic()
+    extra = {}
+    head = head or s3.head_object(Bucket=bucket_name, Key=key)
+    blob.metadata = {
+        SOURCE_ETAG_METADATA: head["ETag"].strip('"'),
+        SOURCE_URI_METADATA: f"s3://{bucket_name}/{key}",
+    }
+    if mode == TRANSFER_MODE_TEMPFILE:
+        with tempfile.NamedTemporaryFile() as tmp_file:
+            s3.download_fileobj(bucket_name, key, tmp_file)
+            tmp_file.flush()
+            total = tmp_file.tell()
+            if transform:
+                tmp_file.seek(0)
+                extra = transform_to_gcs(tmp_file, blob, transform)
+            else:
+                blob.upload_from_filename(tmp_file.name)
+    else:
+        multipart = multipart or multipart_options({})
+        size = head["ContentLength"]
+        # Si hay que descomprimir un zip, se lee por rangos en vez de copiarlo a /tmp
+        read_range = range_fetcher(s3, bucket_name, key, head["ETag"])
+        if mode == TRANSFER_MODE_MULTIPART or size >= multipart["threshold"]:
+            mode = TRANSFER_MODE_MULTIPART
+            executor = ThreadPoolExecutor(max_workers=multipart["concurrency"])
+            try:
+                read_chunk = ranged_reader(
+                    s3, bucket_name, key, size, head["ETag"],
+                    multipart["part_size"], executor, multipart["concurrency"],
+                )
+                total, extra = land_to_gcs(read_chunk, blob, transform, read_range, size)
+            finally:
+                executor.shutdown(wait=True, cancel_futures=True)
+            extra.update({
+                "parts": -(-size // multipart["part_size"]),
+                "part_size": multipart["part_size"],
+                "concurrency": multipart["concurrency"],
+            })
+        else:
+            body = s3.get_object(Bucket=bucket_name, Key=key, IfMatch=head["ETag"])["Body"]
+            try:
+                total, extra = land_to_gcs(lambda: body.read(STREAM_CHUNK_SIZE), blob, transform, read_range, size)
+            finally:
+                body.close()
+
+    elapsed = time.monotonic() - start
+    return {
+        "bytes": total,
+        "duration_s": round(elapsed, 3),
+        "throughput_mb_s": round(total / (1024 * 1024) / elapsed, 2) if elapsed > 0 else None,
+        "transfer_mode": mode,
+        **extra,
+    }
 
 @functions_framework.http
 def download_from_aws(request):
@@ -99,12 +246,21 @@ def download_from_aws(request):
 
     try:
         aws_key, aws_secret = get_aws_credentials()
-        s3 = boto3.client("s3", aws_access_key_id=aws_key, aws_secret_access_key=aws_secret)
+        s3 = boto3.client(
+            "s3",
+            aws_access_key_id=aws_key,
+            aws_secret_access_key=aws_secret,
+            config=Config(max_pool_connections=S3_MAX_POOL_CONNECTIONS),
+        )
 
-        params_list = get_params_from_bigquery(process_name, process_fn_name, arquetype_name)
+        params_list = resolve_params(process_name, process_fn_name, arquetype_name)
         if not params_list:
             return {"error": "No se encontraron parámetros activos en process_params"}, 404
 
+        storage_client = storage.Client()
+        archivos = []
+        bytes_transferred = 0
+        bytes_skipped = 0
         for params in params_list:
             bucket_name = params.get("bucket_name")
             prefix = params.get("prefix")
@@ -115,18 +271,57 @@ def download_from_aws(request):
                 print("[WARNING] Saltando parámetro incompleto:", params)
                 continue
 
-            key = find_most_recent_file(s3, bucket_name, prefix, partial_file_name)
+            incremental = _to_bool(params.get("incremental_listing"))
+            key, last_modified, last_listed, listing = discover_most_recent_file(
+                s3, storage_client, bucket_name, prefix, partial_file_name, incremental
+            )
             print(f"Archivo encontrado en AWS S3: {key}")
 
-            with tempfile.NamedTemporaryFile(delete=False) as tmp_file:
-                s3.download_fileobj(bucket_name, key, tmp_file)
-                tmp_file_path = tmp_file.name
-
             filename = os.path.basename(key)
-            upload_to_gcs(tmp_file_path, f"{gcs_target_path}{filename}")
-            os.remove(tmp_file_path)
+            gcs_path = f"{gcs_target_path}{filename}"
+            mode = (params.get("transfer_mode") or TRANSFER_MODE_STREAM).lower()
+            head = s3.head_object(Bucket=bucket_name, Key=key)
+            blob = gcs_blob(storage_client, gcs_path)
+            transform = transform_options(params)
+            archivo = {"source": f"s3://{bucket_name}/{key}", "gcs_path": gcs_path, "listing": listing}
+
+            # Con transformación se revisa la salida prevista (un zip no tiene nombre previsible)
+            existente = planned_output_name(blob.name, transform)
+            if _to_bool(params.get("skip_unchanged"), default=True) and existente and is_already_transferred(
+                blob.bucket.get_blob(existente), None if transform else head["ContentLength"], head["ETag"]
+            ):
+                destino = f"gs://{blob.bucket.name}/{existente}"
+                print(f"⏭️ {key} ya existe idéntico en {destino}; se omite")
+                archivo.update({"status": "SKIPPED", "gcs_path": destino, "bytes": head["ContentLength"]})
+                bytes_skipped += head["ContentLength"]
+            else:
+                metricas = transfer_s3_to_gcs(
+                    s3, bucket_name, key, blob, mode, multipart_options(params), head, transform
+                )
+                archivo.update({"status": "TRANSFERRED", **metricas})
+                if transform:
+                    # El objeto sin transformar no se escribe: se informan las salidas reales
+                    paths = written_paths(metricas)
+                    archivo.update({"gcs_path": paths[0] if paths else None, "gcs_paths": paths})
+                print(f"✅ {key} -> {archivo['gcs_path']} ({metricas['bytes']} bytes, {metricas['throughput_mb_s']} MB/s)")
+                bytes_transferred += metricas["bytes"]
+            archivos.append(archivo)
+
+            if incremental:
+                source_id = watermark_source_id(bucket_name, prefix, partial_file_name)
+                save_watermark(storage_client, WATERMARK_SOURCE, source_id, {
+                    "start_after": last_listed,
+                    "last_key": key,
+                    "last_modified": last_modified.isoformat(),
+                })
 
-        return {"status": "OK", "message": f"{len(params_list)} archivo(s) procesado(s) correctamente."}, 200
+        return {
+            "status": "OK",
+            "message": f"{len(params_list)} archivo(s) procesado(s) correctamente.",
+            "bytes_transferred": bytes_transferred,
+            "bytes_skipped": bytes_skipped,
+            "archivos": archivos,
+        }, 200
 
     except Exception as e:
         return {"error": str(e)}, 500
@@ -1,9 +1,32 @@
 import functions_framework
+from azure.core import MatchConditions
+from azure.core.exceptions import AzureError
 from azure.storage.blob import ContainerClient
-from google.cloud import storage, secretmanager, bigquery
+from google.cloud import storage, secretmanager
 import os
 import tempfile
 import json
+import base64
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from config_resolver import resolve_params
+from landing_transform import (
+    land_to_gcs, planned_output_name, transform_options, transform_to_gcs, written_paths,
+)
+from watermark_store import load_watermark, save_watermark
+
+WATERMARK_SOURCE = "azure"
+# Metadata del objeto GCS que identifica el origen copiado
+SOURCE_ETAG_METADATA = "source_etag"
+SOURCE_URI_METADATA = "source_uri"
+
+TRANSFER_MODE_STREAM = "stream"
+TRANSFER_MODE_TEMPFILE = "tempfile"
+# Rangos descargados en paralelo desde Azure (configurable por entrada de process_params)
+DEFAULT_MAX_CONCURRENCY = int(os.getenv("AZURE_MAX_CONCURRENCY", "4"))
+DEFAULT_RANGE_SIZE = int(float(os.getenv("AZURE_RANGE_SIZE_MB", "8")) * 1024 * 1024)
 
 def get_azure_sas_url():
     client = secretmanager.SecretManagerServiceClient()
@@ -12,75 +35,188 @@ def get_azure_sas_url():
     payload = json.loads(response.payload.data.decode("UTF-8"))
     return payload["azure_sas_key"]  # URL completa del container con SAS
 
-def find_most_recent_blob(container_client, path, partial_file_name):
-    blobs = container_client.list_blobs(name_starts_with=path)
+def _to_bool(val, default=False):
+    if val is None:
+        return default
+    if isinstance(val, bool):
+        return val
+    if isinstance(val, (int, float)):
+        return val != 0
+    if isinstance(val, str):
+        return val.strip().lower() in {"true", "1", "t", "yes", "y", "si", "sí"}
+    return default
+
+def find_most_recent_blob(container_client, path, partial_file_name, watermark=None):
+    """Retorna (nombre, last_modified, token de la última página) del blob más reciente.
+
+    Con watermark, el listado parte desde la página donde terminó el anterior (continuation
+    token de Azure), lo que asume nombres crecientes en orden lexicográfico (p.ej. con fecha
+    en el nombre). Si no hay blobs nuevos, el más reciente sigue siendo el del watermark.
+    """
+    start_token = watermark.get("page_token") if watermark else None
+    pager = container_client.list_blobs(name_starts_with=path).by_page(continuation_token=start_token)
+
     candidates = []
+    page_token = start_token
+    last_page_token = start_token
+    for page in pager:
+        listed = False
+        for blob in page:
+            listed = True
+            if partial_file_name in blob.name:
+                candidates.append((blob.name, blob.last_modified))
+        if listed:
+            last_page_token = page_token
+        page_token = pager.continuation_token
 
-    for blob in blobs:
-        if partial_file_name in blob.name:
-            candidates.append((blob.name, blob.last_modified))
+    if not candidates and watermark:
+        props = container_client.get_blob_client(watermark["last_blob"]).get_blob_properties()
+        return watermark["last_blob"], props.last_modified, last_page_token
 
     if not candidates:
         raise FileNotFoundError(f"No se encontró ningún archivo con '{partial_file_name}' en '{path}'")
 
-    return max(candidates, key=lambda x: x[1])[0]
-
-def upload_to_gcs(local_path, gcs_path):
-    bucket_name, *blob_parts = gcs_path.replace("gs://", "").split("/", 1)
-    blob_name = blob_parts[0] if blob_parts else os.path.basename(local_path)
-
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(blob_name)
-    blob.upload_from_filename(local_path)
-
-def get_params_from_bigquery(process_name, process_fn_name, arquetype_name):
-    client = bigquery.Client()
-    query = f"""
-        SELECT params
-        FROM `dev_config_zone.process_params`
-        WHERE process_name = @process_name
-          AND process_fn_name = @process_fn_name
-          AND arquetype_name = @arquetype_name
-          AND active = TRUE
+    name, last_modified = max(candidates, key=lambda x: x[1])
+    return name, last_modified, last_page_token
+
+def watermark_source_id(container_url, path, partial_file_name):
+    # La URL del container incluye el SAS: se usa solo la parte sin query string
+    return f"{container_url.split('?', 1)[0]}/{path}|{partial_file_name}"
+
+def discover_most_recent_blob(container_client, storage_client, source_id, path, partial_file_name, incremental):
+    """Busca el blob más reciente usando el watermark si está habilitado.
+
+    Retorna (nombre, last_modified, token de la última página, tipo de listado).
     """
-    job_config = bigquery.QueryJobConfig(
-        query_parameters=[
-            bigquery.ScalarQueryParameter("process_name", "STRING", process_name),
-            bigquery.ScalarQueryParameter("process_fn_name", "STRING", process_fn_name),
-            bigquery.ScalarQueryParameter("arquetype_name", "STRING", arquetype_name),
-        ]
-    )
+    if incremental:
+        watermark = load_watermark(storage_client, WATERMARK_SOURCE, source_id)
+        if watermark and watermark.get("last_blob"):
+            try:
+                found = find_most_recent_blob(container_client, path, partial_file_name, watermark)
+                return (*found, "incremental")
+            except AzureError as e:
+                print(f"[WARNING] Watermark inválido para {source_id} ({e}); se usa listado completo")
+    return (*find_most_recent_blob(container_client, path, partial_file_name), "full")
 
-    results = client.query(query, job_config=job_config).result()
-    param_list = []
+def gcs_blob(storage_client, gcs_path):
+    bucket_name, blob_name = gcs_path.replace("gs://", "").split("/", 1)
+    return storage_client.bucket(bucket_name).blob(blob_name)
 
-    for row in results:
-        param_value = row["params"]
-        print(f"[DEBUG] Valor de params desde BQ: {param_value} — Tipo: {type(param_value)}")
+def is_already_transferred(blob, props, transformed=False):
+    """Indica si el objeto GCS existente es idéntico al blob de Azure (tamaño + ETag o Content-MD5).
 
-        try:
-            if isinstance(param_value, dict):
-                param_list.append(param_value)
-            elif isinstance(param_value, list):
-                param_list.extend(param_value)
-            elif isinstance(param_value, str):
-                loaded = json.loads(param_value)
-                if isinstance(loaded, list):
-                    param_list.extend(loaded)
-                elif isinstance(loaded, dict):
-                    param_list.append(loaded)
-                else:
-                    print(f"[WARNING] Estructura inesperada tras json.loads: {type(loaded)}")
-            else:
-                print(f"[WARNING] Tipo no manejado: {type(param_value)}")
+    Una salida transformada no conserva tamaño ni MD5 del origen, así que solo se compara el ETag.
+    """
+    if blob is None:
+        return False
+    if transformed:
+        return (blob.metadata or {}).get(SOURCE_ETAG_METADATA) == props.etag.strip('"')
+    if blob.size != props.size:
+        return False
+    if (blob.metadata or {}).get(SOURCE_ETAG_METADATA) == props.etag.strip('"'):
+        return True
+    content_md5 = props.content_settings.content_md5
+    if content_md5 and blob.md5_hash:
+        return base64.b64decode(blob.md5_hash) == bytes(content_md5)
+    return False
+
+def range_fetcher(blob_client, etag):
+    """Retorna read_range(offset, length) que descarga ese rango del blob (con el ETag de origen)."""
+    def read_range(offset, length):
+        return blob_client.download_blob(
+            offset=offset, length=length, max_concurrency=1,
+            etag=etag, match_condition=MatchConditions.IfNotModified,
+        ).readall()
+
+    return read_range
 
-        except Exception as e:
-            print(f"[ERROR] Falló parseo de param_value: {e}")
+def ranged_reader(blob_client, size, etag, range_size, executor, concurrency):
+    """Retorna read_chunk() que entrega los rangos del blob en orden.
 
-    return param_list
+    Mantiene hasta `concurrency` rangos descargándose en paralelo. El paralelismo propio del SDK
+    (max_concurrency en download_blob) exige un destino seekable, por eso los rangos se manejan
+    acá y cada uno se pide con max_concurrency=1. El ETag asegura no mezclar versiones del blob.
+    """
+    rangos = iter((inicio, min(range_size, size - inicio)) for inicio in range(0, size, range_size))
+    pendientes = deque()
+    read_range = range_fetcher(blob_client, etag)
+
+    def fetch(rango):
+        return read_range(*rango)
+
+    def llenar():
+        while len(pendientes) < concurrency:
+            rango = next(rangos, None)
+            if rango is None:
+                return
+            pendientes.append(executor.submit(fetch, rango))
+
+    def read_chunk():
+        llenar()
+        if not pendientes:
+            return b""
+        data = pendientes.popleft().result()
+        llenar()
+        return data
 
+    return read_chunk
+
+def transfer_options(params):
+    """Lee de la entrada de process_params el modo, la concurrencia y el tamaño de rango."""
+    range_size_mb = float(params.get("range_size_mb") or DEFAULT_RANGE_SIZE / (1024 * 1024))
+    return {
+        "mode": (params.get("transfer_mode") or TRANSFER_MODE_STREAM).lower(),
+        "max_concurrency": max(1, int(params.get("max_concurrency") or DEFAULT_MAX_CONCURRENCY)),
+        "range_size": max(int(range_size_mb * 1024 * 1024), 1024 * 1024),
+    }
+
+def transfer_azure_to_gcs(blob_client, props, blob, mode=TRANSFER_MODE_STREAM, max_concurrency=DEFAULT_MAX_CONCURRENCY,
+                          range_size=DEFAULT_RANGE_SIZE, transform=None):
+    """Copia un blob de Azure a GCS con memoria acotada y retorna métricas de la transferencia."""
+    start = time.monotonic()
+    extra = {}
+    if mode == TRANSFER_MODE_TEMPFILE:
+        with tempfile.NamedTemporaryFile() as tmp_file:
+            # readinto escribe directo al archivo (seekable), así el SDK puede paralelizar
+            blob_client.download_blob(
+                max_concurrency=max_concurrency, etag=props.etag, match_condition=MatchConditions.IfNotModified
+            ).readinto(tmp_file)
+            tmp_file.flush()
+            total = tmp_file.tell()
+            if transform:
+                tmp_file.seek(0)
+                extra = transform_to_gcs(tmp_file, blob, transform)
+            else:
+                blob.upload_from_filename(tmp_file.name)
+    elif max_concurrency > 1 and props.size > range_size:
+        executor = ThreadPoolExecutor(max_workers=max_concurrency)
+        try:
+            read_chunk = ranged_reader(blob_client, props.size, props.etag, range_size, executor, max_concurrency)
+            total, extra = land_to_gcs(read_chunk, blob, transform, range_fetcher(blob_client, props.etag), props.size)
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+    else:
+        # La descarga se abre recién en la primera lectura: un zip leído por rangos no la usa
+        chunks = []
 
+        def read_chunk():
+            if not chunks:
+                chunks.append(blob_client.download_blob(
+                    max_concurrency=1, etag=props.etag, match_condition=MatchConditions.IfNotModified
+                ).chunks())
+            return next(chunks[0], b"")
+
+        total, extra = land_to_gcs(read_chunk, blob, transform, range_fetcher(blob_client, props.etag), props.size)
+
+    elapsed = time.monotonic() - start
+    return {
+        "bytes": total,
+        "duration_s": round(elapsed, 3),
+        "throughput_mb_s": round(total / (1024 * 1024) / elapsed, 2) if elapsed > 0 else None,
+        "transfer_mode": mode,
+        "max_concurrency": max_concurrency,
+        **extra,
+    }
 
 @functions_framework.http
 def download_from_azure(request):
@@ -99,10 +235,15 @@ def download_from_azure(request):
         container_url = get_azure_sas_url()
         container_client = ContainerClient.from_container_url(container_url)
 
-        params_list = get_params_from_bigquery(process_name, process_fn_name, arquetype_name)
+        params_list = resolve_params(process_name, process_fn_name, arquetype_name)
         if not params_list:
             return {"error": "No se encontraron parámetros activos en process_params"}, 404
 
+        storage_client = storage.Client()
+        archivos = []
+        bytes_transferred = 0
+        bytes_skipped = 0
+
         for params in params_list:
             path = params.get("path")
             partial_file_name = params.get("partial_file_name")
@@ -111,19 +252,62 @@ def download_from_azure(request):
             if not all([path, partial_file_name, gcs_target_path]):
                 continue  # skip si vienen incompletos
 
-            blob_name = find_most_recent_blob(container_client, path, partial_file_name)
+            incremental = _to_bool(params.get("incremental_listing"))
+            source_id = watermark_source_id(container_url, path, partial_file_name)
+            blob_name, last_modified, page_token, listing = discover_most_recent_blob(
+                container_client, storage_client, source_id, path, partial_file_name, incremental
+            )
             print(f"Archivo encontrado: {blob_name}")
 
-            with tempfile.NamedTemporaryFile(delete=False) as tmp_file:
-                download_stream = container_client.download_blob(blob_name)
-                tmp_file.write(download_stream.readall())
-                tmp_file_path = tmp_file.name
-
             filename = os.path.basename(blob_name)
-            upload_to_gcs(tmp_file_path, f"{gcs_target_path}{filename}")
-            os.remove(tmp_file_path)
+            gcs_path = f"{gcs_target_path}{filename}"
+            blob_client = container_client.get_blob_client(blob_name)
+            props = blob_client.get_blob_properties()
+            blob = gcs_blob(storage_client, gcs_path)
+            transform = transform_options(params)
+            archivo = {"source": blob_name, "gcs_path": gcs_path, "listing": listing, "bytes": props.size}
+
+            # Con transformación se revisa la salida prevista (un zip no tiene nombre previsible)
+            existente = planned_output_name(blob.name, transform)
+            if _to_bool(params.get("skip_unchanged"), default=True) and existente and is_already_transferred(
+                blob.bucket.get_blob(existente), props, transformed=bool(transform)
+            ):
+                destino = f"gs://{blob.bucket.name}/{existente}"
+                print(f"⏭️ {blob_name} ya existe idéntico en {destino}; se omite")
+                archivo.update({"status": "SKIPPED", "gcs_path": destino})
+                bytes_skipped += props.size
+            else:
+                # El ETag de origen queda como metadata para detectar reintentos
+                blob.metadata = {
+                    SOURCE_ETAG_METADATA: props.etag.strip('"'),
+                    SOURCE_URI_METADATA: f"{container_client.url.split('?', 1)[0]}/{blob_name}",
+                }
+                metricas = transfer_azure_to_gcs(
+                    blob_client, props, blob, **transfer_options(params), transform=transform
+                )
+                archivo.update({"status": "TRANSFERRED", **metricas})
+                if transform:
+                    # El objeto sin transformar no se escribe: se informan las salidas reales
+                    paths = written_paths(metricas)
+                    archivo.update({"gcs_path": paths[0] if paths else None, "gcs_paths": paths})
+                print(f"✅ {blob_name} -> {archivo['gcs_path']} ({metricas['bytes']} bytes, {metricas['throughput_mb_s']} MB/s)")
+                bytes_transferred += metricas["bytes"]
+            archivos.append(archivo)
+
+            if incremental:
+                save_watermark(storage_client, WATERMARK_SOURCE, source_id, {
+                    "page_token": page_token,
+                    "last_blob": blob_name,
+                    "last_modified": last_modified.isoformat(),
+                })
 
-        return {"status": "OK", "message": f"{len(params_list)} archivo(s) procesado(s) correctamente."}, 200
+        return {
+            "status": "OK",
+            "message": f"{len(params_list)} archivo(s) procesado(s) correctamente.",
+            "bytes_transferred": bytes_transferred,
+            "bytes_skipped": bytes_skipped,
+            "archivos": archivos,
+        }, 200
 
     except Exception as e:
         return {"error": str(e)}, 500
@@ -0,0 +1,57 @@
+"""Watermarks de listado persistidos en GCS.
+
+Cada origen (prefijo S3, path Azure, directorio SFTP) guarda el último archivo
+transferido y, cuando el origen lo soporta, el punto desde el cual continuar el
+listado. Así el descubrimiento del "archivo más reciente" no recorre todo el
+historial en cada ejecución. Si no hay watermark (o no se puede leer) el llamador
+vuelve al listado completo.
+
+Este archivo se copia tal cual en cada función que lo usa (cada carpeta se
+despliega por separado con --source).
+"""
+import hashlib
+import json
+import os
+from datetime import datetime, timezone
+from typing import Optional
+
+WATERMARK_BUCKET = os.getenv("WATERMARK_BUCKET", "dev-deinsoluciones-ingestas")
+WATERMARK_PREFIX = os.getenv("WATERMARK_PREFIX", "_watermarks").strip("/")
+
+
+def watermark_path(source_type: str, source_id: str) -> str:
+    digest = hashlib.sha1(source_id.encode("utf-8")).hexdigest()[:20]
+    return f"{WATERMARK_PREFIX}/{source_type}/{digest}.json"
+
+
+def load_watermark(storage_client, source_type: str, source_id: str) -> Optional[dict]:
+    """Retorna el watermark guardado para el origen, o None si no existe o no se puede leer."""
+    path = watermark_path(source_type, source_id)
+    try:
+        blob = storage_client.bucket(WATERMARK_BUCKET).get_blob(path)
+        if blob is None:
+            return None
+        data = json.loads(blob.download_as_text(encoding="utf-8"))
+    except Exception as e:
+        print(f"[WARNING] No se pudo leer watermark gs://{WATERMARK_BUCKET}/{path}: {e}")
+        return None
+    if data.get("source_id") != source_id:
+        print(f"[WARNING] Watermark gs://{WATERMARK_BUCKET}/{path} no corresponde a {source_id}")
+        return None
+    return data
+
+
+def save_watermark(storage_client, source_type: str, source_id: str, data: dict):
+    """Guarda el watermark del origen. Un error al guardar no interrumpe la transferencia."""
+    path = watermark_path(source_type, source_id)
+    payload = {
+        **data,
+        "source_id": source_id,
+        "updated_utc": datetime.now(timezone.utc).isoformat(),
+    }
+    try:
+        storage_client.bucket(WATERMARK_BUCKET).blob(path).upload_from_string(
+            json.dumps(payload, ensure_ascii=False, default=str), content_type="application/json"
+        )
+    except Exception as e:
+        print(f"[WARNING] No se pudo guardar watermark gs://{WATERMARK_BUCKET}/{path}: {e}")
@@ -1,14 +1,44 @@
+import hashlib
 import io
 import json
 import os
 import re
+import threading
 import time
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime
-from typing import List, Tuple
+from typing import Callable, Dict, List, Optional, Tuple
 
 from google.cloud import storage, bigquery
 import functions_framework
 
+from sql_planner import as_statement, batch_plan, build_plan, critical_path
+from sql_profiler import compare, estimate_bytes, job_stats, load_previous, write_history
+
+# Jobs de BigQuery simultáneos por ejecución (configurable por request con max_concurrency)
+SQL_MAX_CONCURRENCY = int(os.getenv("SQL_MAX_CONCURRENCY", "4"))
+SQL_MAX_CONCURRENCY_CAP = 16
+# Orden por defecto: "sequential" (uno tras otro) o "dag" (paralelo según dependencias,
+# opt-in porque depende del análisis léxico del SQL)
+SQL_ORDERING = os.getenv("SQL_ORDERING", "sequential")
+# Modo batching: archivos consecutivos por job de scripting
+SQL_BATCH_MAX_FILES = int(os.getenv("SQL_BATCH_MAX_FILES", "10"))
+_ERROR_POSITION = re.compile(r"\[(\d+):(\d+)\]")
+# Presupuesto de bytes estimados por job (0 = sin límite); el request puede enviar bytes_budget
+SQL_BYTES_BUDGET = int(os.getenv("SQL_BYTES_BUDGET", "0"))
+# Descarga concurrente de los .sql (tope = pool HTTP de storage.Client) y caché en memoria
+# por (objeto, generation) que se mantiene entre invocaciones de una instancia "warm"
+SQL_DOWNLOAD_WORKERS = 10
+SQL_CACHE_MAX_ENTRIES = int(os.getenv("SQL_CACHE_MAX_ENTRIES", "512"))
+SQL_CACHE_MAX_BYTES = int(os.getenv("SQL_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+
+_cache_lock = threading.Lock()
+_sql_cache: "OrderedDict[Tuple[str, int], Tuple[str, str]]" = OrderedDict()
+_sql_cache_bytes = 0
+# Estados que impiden ejecutar a los scripts que dependen del nodo
+_FAILED = ("error", "skipped", "blocked")
+
 # --- Helpers ---
 def _project_id() -> str:
     return os.getenv("GOOGLE_CLOUD_PROJECT") or "deinsoluciones-serverless"
@@ -20,14 +50,355 @@ def _gcs_split(gs_uri: str) -> Tuple[str, str]:
     bucket, prefix = m.group(1), re.sub(r"/+$", "", m.group(2))
     return bucket, prefix
 
-def _list_sql_objects(bucket: storage.Bucket, prefix: str) -> List[str]:
-    return [b.name for b in bucket.list_blobs(prefix=prefix)
+def _list_sql_objects(bucket: storage.Bucket, prefix: str) -> List[storage.Blob]:
+    return [b for b in bucket.list_blobs(prefix=prefix)
             if b.name.lower().endswith(".sql")]
 
 def _natural_key(s: str):
     # ordena 001_x.sql < 02_y.sql < 10_z.sql
     return [int(t) if t.isdigit() else t.lower() for t in re.split(r"(\d+)", s)]
 
+def _utc_iso() -> str:
+    return datetime.utcnow().isoformat() + "Z"
+
+def _gate(bq_client: bigquery.Client, sql: str, dry_run: bool, profile: bool, budget: int) -> dict:
+    """Estimación previa al job (modo profile o con presupuesto); agrega "blocked" si excede el presupuesto.
+
+    Con presupuesto, un job sin estimación (falló el dry-run) también queda bloqueado: no hay
+    forma de saber si cumple.
+    """
+    if dry_run or not (profile or budget):
+        return {}
+    estimate = estimate_bytes(bq_client, sql)
+    reason = _over_budget(estimate, budget)
+    if reason:
+        estimate["blocked"] = reason
+    return estimate
+
+def _over_budget(estimate: dict, budget: int) -> Optional[str]:
+    if not budget:
+        return None
+    if "estimated_bytes" not in estimate:
+        return f"no estimate under budget {budget}: {estimate.get('estimate_error')}"
+    if (estimate["estimated_bytes"] or 0) > budget:
+        return f"estimated {estimate['estimated_bytes']} bytes > budget {budget}"
+    return None
+
+def _run_job(bq_client: bigquery.Client, fname: str, sql: str, dry_run: bool,
+             profile: bool = False, budget: int = 0) -> dict:
+    started = _utc_iso()
+    t0 = time.monotonic()
+    estimate = _gate(bq_client, sql, dry_run, profile, budget)
+    if "blocked" in estimate:
+        return {"file": fname, "status": "blocked", "reason": estimate.pop("blocked"), **estimate,
+                "started_utc": started, "ended_utc": _utc_iso(), "duration_ms": 0}
+    try:
+        job_config = bigquery.QueryJobConfig(dry_run=dry_run)
+        job = bq_client.query(sql, job_config=job_config)
+        if not dry_run:
+            job.result()  # espera a que termine
+        result = {
+            "file": fname,
+            "status": "done" if not dry_run else "dry-run",
+            "job_id": job.job_id,
+            "location": job.location,
+            **estimate,
+            **job_stats(job),
+        }
+        if dry_run:
+            result["estimated_bytes"] = job.total_bytes_processed
+    except Exception as e:
+        result = {"file": fname, "status": "error", "error": str(e), **estimate}
+    result.update({
+        "started_utc": started,
+        "ended_utc": _utc_iso(),
+        "duration_ms": int((time.monotonic() - t0) * 1000),
+    })
+    return result
+
+def _sql_hash(sql: str) -> str:
+    return hashlib.sha256(sql.encode("utf-8")).hexdigest()
+
+def _cache_get(key: Tuple[str, int]) -> Optional[Tuple[str, str]]:
+    with _cache_lock:
+        entry = _sql_cache.get(key)
+        if entry is not None:
+            _sql_cache.move_to_end(key)
+        return entry
+
+def _cache_put(key: Tuple[str, int], entry: Tuple[str, str]):
+    global _sql_cache_bytes
+    size = len(entry[0])
+    if size > SQL_CACHE_MAX_BYTES:
+        return
+    with _cache_lock:
+        if key not in _sql_cache:
+            _sql_cache[key] = entry
+            _sql_cache_bytes += size
+        while _sql_cache and (len(_sql_cache) > SQL_CACHE_MAX_ENTRIES or _sql_cache_bytes > SQL_CACHE_MAX_BYTES):
+            _, (sql, _) = _sql_cache.popitem(last=False)
+            _sql_cache_bytes -= len(sql)
+
+def _prefetch_scripts(blobs: List[storage.Blob]) -> Tuple[Dict[str, Tuple[str, str]], dict]:
+    """Descarga en paralelo los .sql (texto sin espacios extremos + sha256), usando el caché LRU.
+
+    La clave del caché es (nombre, generation) del listado: si el objeto se reemplaza cambia la
+    generation y se vuelve a descargar. La descarga exige esa generation, así el texto
+    corresponde exactamente al objeto listado.
+    """
+    contenidos: Dict[str, Tuple[str, str]] = {}
+    faltantes = []
+    for blob in blobs:
+        entry = _cache_get((blob.name, blob.generation))
+        if entry is None:
+            faltantes.append(blob)
+        else:
+            contenidos[blob.name] = entry
+
+    def _download(blob: storage.Blob) -> Tuple[str, str]:
+        sql = blob.download_as_text(encoding="utf-8", if_generation_match=blob.generation).strip()
+        entry = (sql, _sql_hash(sql))
+        _cache_put((blob.name, blob.generation), entry)
+        return entry
+
+    t0 = time.monotonic()
+    if faltantes:
+        with ThreadPoolExecutor(max_workers=min(SQL_DOWNLOAD_WORKERS, len(faltantes))) as executor:
+            for blob, entry in zip(faltantes, executor.map(_download, faltantes)):
+                contenidos[blob.name] = entry
+    stats = {
+        "files": len(blobs),
+        "cache_hits": len(blobs) - len(faltantes),
+        "downloaded": len(faltantes),
+        "download_ms": int((time.monotonic() - t0) * 1000),
+    }
+    return contenidos, stats
+
+def _run_id(value: str) -> str:
+    return re.sub(r"[^\w.-]", "_", value.strip())[:128]
+
+def _load_manifest(bucket: storage.Bucket, checkpoint_dir: str, run_id: Optional[str]) -> Optional[dict]:
+    """Lee el manifiesto del run_id indicado o, si no se indica, el último escrito."""
+    if run_id:
+        blob = bucket.get_blob(f"{checkpoint_dir}/{run_id}.json")
+    else:
+        blobs = [b for b in bucket.list_blobs(prefix=f"{checkpoint_dir}/") if b.name.endswith(".json")]
+        blob = max(blobs, key=lambda b: b.updated, default=None)
+    if blob is None:
+        return None
+    return json.loads(blob.download_as_text(encoding="utf-8"))
+
+def _resumable(plan: Dict[str, dict], hashes: Dict[str, str], manifest: Optional[dict]) -> Dict[str, dict]:
+    """Scripts que ya terminaron bien con el mismo SQL y cuyas dependencias tampoco se re-ejecutan.
+
+    Si una dependencia cambió o falló, el script se vuelve a correr aunque su SQL sea igual,
+    porque sus tablas de entrada pueden haber cambiado.
+    """
+    previos = (manifest or {}).get("files", {})
+    resumed: Dict[str, dict] = {}
+    for nombre in plan:  # orden natural: las dependencias siempre se evalúan antes
+        previo = previos.get(nombre) or {}
+        if (previo.get("status") == "done" and previo.get("sha256") == hashes[nombre]
+                and all(d in resumed for d in plan[nombre]["depends_on"])):
+            resumed[nombre] = {
+                "file": nombre,
+                "status": "resumed",
+                "job_id": previo.get("job_id"),
+                "location": previo.get("location"),
+                "reason": f"checkpoint {manifest.get('run_id')} ({previo.get('ended_utc')})",
+            }
+    return resumed
+
+def _run_unbatched(bq_client: bigquery.Client, files: List[str], scripts: Dict[str, str],
+                   profile: bool, budget: int) -> dict:
+    """Ejecuta los archivos de un lote uno tras otro (cada uno con su _gate) con la semántica del lote:
+    el primero que falla o queda bloqueado detiene a los siguientes."""
+    started = _utc_iso()
+    t0 = time.monotonic()
+    results: Dict[str, dict] = {}
+    fallido = None
+    for fname in files:
+        if fallido:
+            results[fname] = {"file": fname, "batch": files[0], "status": "skipped",
+                              "reason": f"batch aborted at {fallido}"}
+            continue
+        results[fname] = {**_run_job(bq_client, fname, scripts[fname], False, profile, budget), "batch": files[0]}
+        if results[fname]["status"] in ("error", "blocked"):
+            fallido = fname
+    return {
+        "file": files[0],
+        "status": results[fallido]["status"] if fallido else "done",
+        "unbatched": True,
+        "started_utc": started,
+        "ended_utc": _utc_iso(),
+        "duration_ms": int((time.monotonic() - t0) * 1000),
+        "files": results,
+    }
+
+def _run_batch(bq_client: bigquery.Client, files: List[str], scripts: Dict[str, str], dry_run: bool,
+               profile: bool = False, budget: int = 0) -> dict:
+    """Ejecuta varios archivos como un solo job de scripting y reparte el resultado por archivo.
+
+    Cada sentencia del script genera un job hijo; su stack frame indica la línea de inicio, y
+    con los rangos de líneas de cada archivo se asigna el job hijo (y su error, si falló) al
+    archivo de origen. Si el script falla, los archivos posteriores al que falló no se ejecutaron.
+    """
+    if len(files) == 1:
+        result = _run_job(bq_client, files[0], scripts[files[0]], dry_run, profile, budget)
+        return {**result, "files": {files[0]: result}}
+
+    partes, rangos, linea = [], [], 1
+    for fname in files:
+        cuerpo = as_statement(scripts[fname])
+        lineas = cuerpo.count("\n") + 1
+        rangos.append((linea, linea + lineas - 1, fname))
+        partes.append(cuerpo)
+        linea += lineas
+    script = "\n".join(partes)
+
+    def _owner(line: Optional[int]) -> Optional[str]:
+        return next((f for ini, fin, f in rangos if line is not None and ini <= line <= fin), None)
+
+    started = _utc_iso()
+    t0 = time.monotonic()
+    # Con batching se estima cada archivo por separado (un dry-run del script completo falla si
+    # un archivo lee una tabla que crea otro anterior del lote); el presupuesto aplica a la suma
+    estimates: Dict[str, dict] = {}
+    if not dry_run and (profile or budget):
+        estimates = {f: estimate_bytes(bq_client, scripts[f]) for f in files}
+        if budget and any("estimated_bytes" not in e for e in estimates.values()):
+            # Sin estimación completa no se puede controlar el lote: se ejecuta archivo por
+            # archivo, así cada uno se estima (con las tablas previas ya creadas) al lanzarlo
+            return _run_unbatched(bq_client, files, scripts, profile, budget)
+    estimate = {}
+    if estimates and all("estimated_bytes" in e for e in estimates.values()):
+        estimate["estimated_bytes"] = sum(e["estimated_bytes"] or 0 for e in estimates.values())
+    reason = _over_budget(estimate, budget) if estimates else None
+    if reason:
+        results = {f: {"file": f, "batch": files[0], "status": "blocked", "reason": reason, **estimates[f]}
+                   for f in files}
+        return {"file": files[0], "status": "blocked", "reason": reason, **estimate,
+                "started_utc": started, "ended_utc": _utc_iso(), "duration_ms": 0, "files": results}
+    job, error = None, None
+    try:
+        job = bq_client.query(script, job_config=bigquery.QueryJobConfig(dry_run=dry_run))
+        if not dry_run:
+            job.result()
+    except Exception as e:
+        error = str(e)
+    ended = _utc_iso()
+    duration_ms = int((time.monotonic() - t0) * 1000)
+
+    por_archivo: Dict[str, List] = {f: [] for f in files}
+    fallido = None
+    if job is not None and not dry_run:
+        try:
+            for child in bq_client.list_jobs(parent_job=job.job_id):
+                frames = child.script_statistics.stack_frames if child.script_statistics else []
+                fname = _owner(frames[0].start_line if frames else None)
+                if fname:
+                    por_archivo[fname].append(child)
+                    if child.error_result:
+                        fallido = fname
+        except Exception as e:
+            print(f"[WARNING] No se pudieron listar los jobs hijos de {job.job_id}: {e}")
+    if error and fallido is None:
+        m = _ERROR_POSITION.search(error)
+        fallido = _owner(int(m.group(1)) if m else None)
+
+    results: Dict[str, dict] = {}
+    estado = "dry-run" if dry_run else "done"
+    despues_del_fallo = False
+    for fname in files:
+        hijos = por_archivo[fname]
+        base = {"file": fname, "batch": files[0], "location": job.location if job else None,
+                "job_id": job.job_id if job else None,
+                "child_job_ids": [c.job_id for c in hijos], **estimates.get(fname, {})}
+        inicios = [c.started for c in hijos if c.started]
+        fines = [c.ended for c in hijos if c.ended]
+        if inicios and fines:
+            base.update({
+                "started_utc": min(inicios).isoformat(),
+                "ended_utc": max(fines).isoformat(),
+                "duration_ms": int((max(fines) - min(inicios)).total_seconds() * 1000),
+            })
+        else:
+            base.update({"started_utc": started, "ended_utc": ended, "duration_ms": duration_ms})
+
+        if hijos:
+            stats = [job_stats(c) for c in hijos]
+            for clave in ("total_bytes_processed", "total_bytes_billed", "slot_millis"):
+                base[clave] = sum(st[clave] or 0 for st in stats)
+            base["cache_hit"] = all(st["cache_hit"] for st in stats)
+
+        if error is None:
+            results[fname] = {**base, "status": estado}
+        elif fallido is None:
+            # No se pudo ubicar la sentencia que falló: todo el lote queda con error
+            results[fname] = {**base, "status": "error", "error": error}
+        elif despues_del_fallo:
+            results[fname] = {"file": fname, "batch": files[0], "status": "skipped",
+                              "reason": f"batch aborted at {fallido}"}
+        elif fname == fallido:
+            results[fname] = {**base, "status": "error", "error": error}
+            despues_del_fallo = True
+        else:
+            results[fname] = {**base, "status": estado}
+
+    return {
+        "file": files[0],
+        "status": "error" if error else estado,
+        **estimate,
+        "job_id": job.job_id if job else None,
+        "started_utc": started,
+        "ended_utc": ended,
+        "duration_ms": duration_ms,
+        "files": results,
+    }
+
+def _execute_plan(plan: Dict[str, dict], runner: Callable[[str], dict], max_concurrency: int,
+                  completed: Optional[Dict[str, dict]] = None,
+                  on_result: Optional[Callable[[str, dict], None]] = None,
+                  stop_on_error: bool = True) -> Dict[str, dict]:
+    """Ejecuta los nodos del plan con runner(nombre), respetando el DAG, hasta max_concurrency a la vez.
+
+    Entre scripts listos se respeta el orden natural. Con stop_on_error, si un script falla los
+    que dependen de él (directa o indirectamente) quedan "skipped"; en modo dag esto incluye a
+    todos los posteriores a una barrera. Sin stop_on_error (ordering=sequential) una dependencia
+    fallida solo fija el orden y todos los scripts se ejecutan, como el loop original.
+    `completed` trae resultados ya resueltos (checkpoint) que cuentan como exitosos; on_result
+    se llama al terminar cada job.
+    """
+    results: Dict[str, dict] = dict(completed or {})
+    orden = [n for n in plan if n not in results]
+    pendientes = {n: set(plan[n]["depends_on"]) for n in orden}
+    en_curso = {}
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        while pendientes or en_curso:
+            for nombre in [n for n in orden if n in pendientes]:
+                fallidas = [
+                    d for d in pendientes[nombre] if d in results and results[d]["status"] in _FAILED
+                ] if stop_on_error else []
+                if fallidas:
+                    del pendientes[nombre]
+                    results[nombre] = {"file": nombre, "status": "skipped",
+                                       "reason": f"dependency failed: {', '.join(sorted(fallidas))}"}
+                    continue
+                if len(en_curso) >= max_concurrency:
+                    break
+                if all(d in results for d in pendientes[nombre]):
+                    del pendientes[nombre]
+                    en_curso[executor.submit(runner, nombre)] = nombre
+            if not en_curso:
+                continue
+            terminados, _ = wait(list(en_curso), return_when=FIRST_COMPLETED)
+            for future in terminados:
+                nombre = en_curso.pop(future)
+                results[nombre] = future.result()
+                if on_result:
+                    on_result(nombre, results[nombre])
+    return results
+
 def _write_log(bucket: storage.Bucket, path: str, content: str, content_type="application/json"):
     blob = bucket.blob(path)
     bio = io.BytesIO(content.encode("utf-8"))
@@ -56,7 +427,7 @@ def exec_sql(request):
     objs = _list_sql_objects(bucket, target_prefix)
     if not objs:
         return (json.dumps({"error": f"No se encontraron .sql en gs://{bucket_name}/{target_prefix}"}), 404)
-    objs = sorted(objs, key=_natural_key)
+    objs = sorted(objs, key=lambda b: _natural_key(b.name))
 
     bq_client = bigquery.Client(project=bq_project)
 
@@ -67,39 +438,159 @@ def exec_sql(request):
 
     results = []
     lines = []
-    ok = True
 
-    for obj_name in objs:
-        fname = obj_name.split("/")[-1]
-        sql = bucket.blob(obj_name).download_as_text(encoding="utf-8").strip()
-        if not sql:
+    # descargar scripts en paralelo (o desde el caché); los vacíos se informan y quedan fuera del plan
+    contenidos, prefetch = _prefetch_scripts(objs)
+    lines.append(f"[FETCH] {prefetch['files']} archivo(s): {prefetch['cache_hits']} desde caché, "
+                 f"{prefetch['downloaded']} descargados en {prefetch['download_ms']} ms")
+    scripts: Dict[str, str] = {}
+    hashes: Dict[str, str] = {}
+    for obj in objs:
+        fname = obj.name.split("/")[-1]
+        sql, digest = contenidos[obj.name]
+        if sql:
+            scripts[fname] = sql
+            hashes[fname] = digest
+
+    sequential = str(data.get("ordering", SQL_ORDERING)).lower() == "sequential"
+    try:
+        max_concurrency = int(data.get("max_concurrency") or SQL_MAX_CONCURRENCY)
+    except (TypeError, ValueError):
+        max_concurrency = SQL_MAX_CONCURRENCY
+    max_concurrency = max(1, min(max_concurrency, SQL_MAX_CONCURRENCY_CAP))
+    plan = build_plan(list(scripts.items()), bq_project, sequential=sequential)
+
+    # checkpoint por (process_name, run_id) junto a _logs; un dry-run no lee ni escribe checkpoints
+    checkpoint_dir = f"{target_prefix}/_checkpoints"
+    run_id = _run_id(str(data.get("run_id") or "")) or None
+    resume = bool(data.get("resume", False)) and not dry_run
+    manifest = _load_manifest(bucket, checkpoint_dir, run_id) if resume else None
+    completed = _resumable(plan, hashes, manifest) if manifest else {}
+    if resume and manifest is None:
+        lines.append(f"[RESUME] sin checkpoint previo para run_id={run_id or '(último)'}; se ejecuta todo")
+    run_id = run_id or (manifest or {}).get("run_id") or ts
+    checkpoint_path = f"{checkpoint_dir}/{run_id}.json"
+    checkpoint = {
+        "process_name": process_name,
+        "run_id": run_id,
+        "sql_dir_gcs": f"gs://{bucket_name}/{target_prefix}",
+        "files": dict((manifest or {}).get("files", {})),
+    }
+
+    def _checkpoint(node: str, result: dict):
+        if dry_run:
+            return
+        for fname, file_result in (result.get("files") or {node: result}).items():
+            if file_result["status"] == "skipped":
+                continue
+            checkpoint["files"][fname] = {
+                "sha256": hashes[fname],
+                "status": file_result["status"],
+                "job_id": file_result.get("job_id"),
+                "location": file_result.get("location"),
+                "ended_utc": file_result.get("ended_utc"),
+            }
+        checkpoint["updated_utc"] = _utc_iso()
+        _write_log(bucket, checkpoint_path, json.dumps(checkpoint, ensure_ascii=False, indent=2))
+
+    profile = bool(data.get("profile", False))
+    try:
+        bytes_budget = int(data.get("bytes_budget") or SQL_BYTES_BUDGET)
+    except (TypeError, ValueError):
+        bytes_budget = SQL_BYTES_BUDGET
+    previous = load_previous(bq_client, process_name) if profile else {}
+
+    batching = bool(data.get("batching", False))
+    if batching:
+        # opt-in: archivos consecutivos comparten un job de scripting (menos overhead por job)
+        batch_max_files = max(1, int(data.get("batch_max_files") or SQL_BATCH_MAX_FILES))
+        lotes, lplan = batch_plan(plan, scripts, set(completed), batch_max_files)
+        por_lote = _execute_plan(
+            lplan, lambda lote: _run_batch(bq_client, lotes[lote], scripts, dry_run, profile, bytes_budget),
+            max_concurrency, on_result=_checkpoint, stop_on_error=not sequential,
+        )
+        executed = dict(completed)
+        for lote, result in por_lote.items():
+            for fname in lotes[lote]:
+                if "files" in result:
+                    executed[fname] = result["files"][fname]
+                else:  # lote omitido porque falló una dependencia
+                    executed[fname] = {**result, "file": fname, "batch": lote}
+    else:
+        executed = _execute_plan(
+            plan, lambda fname: _run_job(bq_client, fname, scripts[fname], dry_run, profile, bytes_budget),
+            max_concurrency, completed, _checkpoint, stop_on_error=not sequential,
+        )
+
+    for obj in objs:
+        fname = obj.name.split("/")[-1]
+        if fname not in scripts:
             results.append({"file": fname, "status": "skipped", "reason": "empty file"})
             lines.append(f"[SKIP] {fname} (vacío)")
             continue
+        result = executed[fname]
+        result["depends_on"] = sorted(plan[fname]["depends_on"], key=_natural_key)
+        compare(result, previous.get(fname))
+        results.append(result)
+        if result["status"] == "error":
+            lines.append(f"[ERR] {fname} -> {result['error']}")
+        elif result["status"] in ("skipped", "resumed"):
+            lines.append(f"[SKIP] {fname} ({result['reason']})")
+        elif result["status"] == "blocked":
+            lines.append(f"[BLOCK] {fname} ({result['reason']})")
+        else:
+            lines.append(f"[OK] {fname} -> job_id={result['job_id']} "
+                         f"{result['started_utc']} .. {result['ended_utc']} ({result['duration_ms']} ms)")
+    ok = not any(r["status"] in ("error", "blocked") for r in results)
 
-        try:
-            job_config = bigquery.QueryJobConfig(dry_run=dry_run)
-            job = bq_client.query(sql, job_config=job_config)
-            if not dry_run:
-                job.result()  # espera a que termine
-            state = "done" if not dry_run else "dry-run"
-            results.append({
-                "file": fname,
-                "status": state,
-                "job_id": job.job_id,
-                "location": job.location,
-            })
-            lines.append(f"[OK] {fname} -> job_id={job.job_id}")
-        except Exception as e:
-            ok = False
-            results.append({"file": fname, "status": "error", "error": str(e)})
-            lines.append(f"[ERR] {fname} -> {e}")
+    cost = {k: sum(r.get(k) or 0 for r in results)
+            for k in ("estimated_bytes", "total_bytes_processed", "total_bytes_billed", "slot_millis")}
+    cost["cache_hits"] = sum(1 for r in results if r.get("cache_hit"))
+    cost["bytes_budget"] = bytes_budget or None
+    if profile:
+        logged = _utc_iso()
+        write_history(bq_client, [{
+            "process_name": process_name,
+            "run_id": run_id,
+            "file": r["file"],
+            "sha256": hashes.get(r["file"]),
+            "status": r["status"],
+            "job_id": r.get("job_id"),
+            "dry_run": dry_run,
+            "estimated_bytes": r.get("estimated_bytes"),
+            "total_bytes_processed": r.get("total_bytes_processed"),
+            "total_bytes_billed": r.get("total_bytes_billed"),
+            "slot_millis": r.get("slot_millis"),
+            "cache_hit": r.get("cache_hit"),
+            "duration_ms": r.get("duration_ms"),
+            "started_utc": r.get("started_utc"),
+            "ended_utc": r.get("ended_utc"),
+            "logged_utc": logged,
+        } for r in results if r["status"] not in ("skipped", "resumed")])
+
+    camino, camino_ms = critical_path(plan, {n: r.get("duration_ms", 0) for n, r in executed.items()})
+    plan_summary = {
+        "ordering": "sequential" if sequential else "dag",
+        "batching": batching,
+        "jobs": len(lotes) if batching else len(plan) - len(completed),
+        "max_concurrency": max_concurrency,
+        "barriers": [n for n in plan if plan[n]["barrier"]],
+        "critical_path": camino,
+        "critical_path_ms": camino_ms,
+    }
+    lines.append(f"[PLAN] critical_path={' -> '.join(camino)} ({camino_ms} ms)")
 
     # subir logs a GCS
     osumm = {
         "sql_dir_gcs": f"gs://{bucket_name}/{target_prefix}",
         "bq_project": bq_project,
         "dry_run": dry_run,
+        "run_id": run_id,
+        "resumed": sorted(completed, key=_natural_key),
+        "gcs_checkpoint": None if dry_run else f"gs://{bucket_name}/{checkpoint_path}",
+        "prefetch": prefetch,
+        "plan": plan_summary,
+        "cost": cost,
         "results": results,
         "finished_utc": datetime.utcnow().isoformat() + "Z",
     }
@@ -109,6 +600,7 @@ def exec_sql(request):
     return (json.dumps({
         "status": "ok" if ok else "partial",
         "processed": len(results),
+        "run_id": run_id,
         "gcs_log_json": f"gs://{bucket_name}/{log_json_path}",
         "gcs_log_txt": f"gs://{bucket_name}/{log_txt_path}",
         "results": results
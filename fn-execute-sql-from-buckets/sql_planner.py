@@ -0,0 +1,235 @@
+"""Planificador de ejecución de scripts SQL como DAG de dependencias.
+
+Cada script se analiza para obtener las tablas que lee y las que escribe. Entre dos
+scripts hay dependencia (respetando el orden natural de los archivos) si uno escribe
+una tabla que el otro lee o escribe. Los scripts sin dependencias entre sí pueden
+correr en paralelo. El análisis es léxico (regex sobre el SQL sin comentarios ni
+strings); si un script no se puede analizar con confianza se trata como barrera.
+
+Directivas en comentarios del script:
+    -- @barrier                   espera a todos los anteriores y bloquea a los siguientes
+    -- @depends_on: 010_a.sql, b  dependencias explícitas (por nombre de archivo)
+"""
+import re
+from typing import Dict, List, Optional, Set, Tuple
+
+# Un solo tokenizador de izquierda a derecha: gana lo que aparece primero, así un apóstrofo
+# dentro de un comentario no abre un string y un "--" dentro de un string no es comentario
+_TOKEN = re.compile(
+    r"(?P<ident>`[^`]*`)"
+    r"|(?P<comment>/\*.*?\*/|--[^\n]*|#[^\n]*)"
+    r"|(?P<string>'''.*?'''|\"\"\".*?\"\"\"|'(?:[^'\\\n]|\\.)*'|\"(?:[^\"\\\n]|\\.)*\")",
+    re.S,
+)
+# Nombre calificado: `p.ds.t`, p.ds.t, ds.t o con cada parte entre backticks (`p`.`ds`.`t`)
+_PART = r"(?:`[^`]+`|[A-Za-z_][\w-]*)"
+_IDENT = r"(" + _PART + r"(?:\." + _PART + r")+|`[^`]+`)"
+
+_WRITE_PATTERNS = [
+    re.compile(r"\bINSERT\s+(?:INTO\s+)?" + _IDENT, re.I),
+    re.compile(r"\bUPDATE\s+" + _IDENT, re.I),
+    re.compile(r"\bDELETE\s+(?:FROM\s+)?" + _IDENT, re.I),
+    re.compile(r"\bMERGE\s+(?:INTO\s+)?" + _IDENT, re.I),
+    re.compile(r"\bTRUNCATE\s+TABLE\s+" + _IDENT, re.I),
+    re.compile(
+        r"\bCREATE\s+(?:OR\s+REPLACE\s+)?(?:TEMP(?:ORARY)?\s+)?(?:EXTERNAL\s+|SNAPSHOT\s+)?"
+        r"(?:TABLE|VIEW|MATERIALIZED\s+VIEW)\s+(?:IF\s+NOT\s+EXISTS\s+)?" + _IDENT, re.I),
+    re.compile(r"\bDROP\s+(?:TABLE|VIEW|MATERIALIZED\s+VIEW)\s+(?:IF\s+EXISTS\s+)?" + _IDENT, re.I),
+    re.compile(r"\bALTER\s+(?:TABLE|VIEW)\s+(?:IF\s+EXISTS\s+)?" + _IDENT, re.I),
+]
+# Los FROM se leen aparte con su lista completa (_from_tables)
+_READ_PATTERN = re.compile(r"\b(?:JOIN|USING|CLONE|LIKE|COPY)\s+" + _IDENT, re.I)
+# Lista de FROM separada por comas: se recorre hasta la cláusula siguiente (a profundidad 0)
+_FROM = re.compile(r"\bFROM\b", re.I)
+_FROM_END = re.compile(
+    r"(?:WHERE|GROUP|HAVING|QUALIFY|WINDOW|ORDER|LIMIT|UNION|INTERSECT|EXCEPT|SELECT|SET|"
+    r"INSERT|UPDATE|DELETE|MERGE|CREATE|DROP|ALTER|TRUNCATE)\b", re.I)
+_FROM_TABLE = re.compile(r"\s*" + _IDENT)
+# Elementos de la lista que no son tablas: subconsulta, UNNEST, literal o un nombre simple
+# (alias o columna)
+_FROM_OTHER = re.compile(r"\s*(?:\(|UNNEST\b|'|\d|[A-Za-z_]\w*(?![\w.`-]))", re.I)
+# FROM que no abre una lista de tablas: a IS DISTINCT FROM b, EXTRACT(DAY FROM fecha), TRIM(x FROM y)
+_NOT_TABLE_FROM = re.compile(r"(?:\bDISTINCT\s*|\b(?:EXTRACT|TRIM|SUBSTRING)\s*\([^()]*)$", re.I)
+# Sentencias cuyo efecto no se puede inferir del texto: el script pasa a ser barrera
+_OPAQUE = re.compile(r"\b(?:CALL|EXECUTE\s+IMMEDIATE|EXPORT\s+DATA|LOAD\s+DATA)\b", re.I)
+_BARRIER = re.compile(r"--\s*@barrier\b", re.I)
+# DECLARE solo es válido al inicio de un script de BigQuery: esos archivos no se agrupan
+_DECLARE = re.compile(r"\bDECLARE\b", re.I)
+_DEPENDS_ON = re.compile(r"--\s*@depends_on\s*:\s*([^\n]+)", re.I)
+
+
+def _token(m: "re.Match") -> str:
+    if m.lastgroup == "comment":
+        return " "
+    if m.lastgroup == "string":
+        return "''"
+    return m.group(0)
+
+
+def _strip(sql: str) -> str:
+    """Quita comentarios y reemplaza los strings por '' (los identificadores `...` se mantienen)."""
+    return _TOKEN.sub(_token, sql)
+
+
+def _normalize(ident: str, default_project: str) -> str:
+    partes = ident.replace("`", "").lower().split(".")
+    if len(partes) == 2:
+        partes = [default_project.lower()] + partes
+    return ".".join(partes)
+
+
+def _from_items(limpio: str, inicio: int) -> List[str]:
+    """Elementos separados por coma (a profundidad 0) de la lista que empieza en `inicio`."""
+    items = []
+    depth = 0
+    pos = desde = inicio
+    while pos < len(limpio):
+        c = limpio[pos]
+        if c == "`":
+            pos = limpio.find("`", pos + 1) + 1 or len(limpio)
+            continue
+        if c == "(":
+            depth += 1
+        elif c == ")":
+            if depth == 0:
+                break
+            depth -= 1
+        elif depth == 0 and c == ";":
+            break
+        elif depth == 0 and c == ",":
+            items.append(limpio[desde:pos])
+            desde = pos + 1
+        elif depth == 0 and c.isalpha() and not (limpio[pos - 1].isalnum() or limpio[pos - 1] in "_.") \
+                and _FROM_END.match(limpio, pos):
+            break
+        pos += 1
+    items.append(limpio[desde:pos])
+    return items
+
+
+def _from_tables(limpio: str, default_project: str) -> Tuple[Set[str], bool]:
+    """Tablas de todas las listas FROM (incluye comma joins); (tablas, hay elementos no reconocidos)."""
+    tablas: Set[str] = set()
+    dudoso = False
+    for m in _FROM.finditer(limpio):
+        if _NOT_TABLE_FROM.search(limpio, max(0, m.start() - 200), m.start()):
+            continue
+        for item in _from_items(limpio, m.end()):
+            tabla = _FROM_TABLE.match(item)
+            if tabla:
+                tablas.add(_normalize(tabla.group(1), default_project))
+            elif not _FROM_OTHER.match(item):
+                dudoso = True
+    return tablas, dudoso
+
+
+def extract_table_refs(sql: str, default_project: str) -> Tuple[Set[str], Set[str], bool]:
+    """Retorna (tablas leídas, tablas escritas, opaco) del script.
+
+    Es opaco si tiene sentencias cuyo efecto no se infiere del texto o una lista FROM con
+    elementos que no se pudieron reconocer.
+    """
+    limpio = _strip(sql)
+    writes = {_normalize(m.group(1), default_project) for p in _WRITE_PATTERNS for m in p.finditer(limpio)}
+    reads = {_normalize(m.group(1), default_project) for m in _READ_PATTERN.finditer(limpio)}
+    from_reads, dudoso = _from_tables(limpio, default_project)
+    return reads | from_reads, writes, bool(_OPAQUE.search(limpio)) or dudoso
+
+
+def batchable(sql: str) -> bool:
+    """Indica si el script se puede concatenar con otros en un mismo job de scripting."""
+    limpio = _strip(sql)
+    return not _DECLARE.search(limpio) and not _BARRIER.search(sql)
+
+
+def as_statement(sql: str) -> str:
+    """Retorna el script terminado en ';' para poder concatenarlo con el siguiente."""
+    sql = sql.rstrip()
+    return sql if _strip(sql).rstrip().endswith(";") else sql + "\n;"
+
+
+def build_plan(scripts: List[Tuple[str, str]], default_project: str, sequential: bool = False) -> Dict[str, dict]:
+    """Arma el DAG para los scripts (nombre, sql) ya ordenados de forma natural.
+
+    Retorna {nombre: {"reads", "writes", "barrier", "depends_on"}}. Con sequential=True cada
+    script depende del anterior (comportamiento original).
+    """
+    plan: Dict[str, dict] = {}
+    nombres = [nombre for nombre, _ in scripts]
+    for i, (nombre, sql) in enumerate(scripts):
+        reads, writes, opaco = extract_table_refs(sql, default_project)
+        explicitas = set()
+        for m in _DEPENDS_ON.finditer(sql):
+            explicitas.update(d.strip() for d in m.group(1).split(",") if d.strip())
+        # Un script que escribe pero del que no se pudo extraer nada se trata como barrera
+        barrier = bool(_BARRIER.search(sql)) or opaco or (not reads and not writes)
+        depends_on = {d for d in explicitas if d in plan}
+        for previo in nombres[:i]:
+            p = plan[previo]
+            if sequential or barrier or p["barrier"]:
+                depends_on.add(previo)
+            elif p["writes"] & (reads | writes) or writes & p["reads"]:
+                depends_on.add(previo)
+        plan[nombre] = {
+            "reads": reads,
+            "writes": writes,
+            "barrier": barrier,
+            "depends_on": depends_on,
+        }
+    return plan
+
+
+def batch_plan(plan: Dict[str, dict], scripts: Dict[str, str], skip: Set[str],
+               max_files: int) -> Tuple[Dict[str, List[str]], Dict[str, dict]]:
+    """Agrupa archivos consecutivos (orden natural) en lotes para un solo job de scripting.
+
+    Las barreras y los scripts no agrupables van solos. Un lote depende de otro si alguno de
+    sus archivos depende de un archivo del otro; como los lotes son tramos consecutivos y las
+    dependencias apuntan siempre hacia atrás, el resultado sigue siendo un DAG. `skip` son
+    archivos ya resueltos (checkpoint) que no se ejecutan.
+    Retorna ({lote: [archivos]}, {lote: {"depends_on", "barrier"}}), con el lote nombrado por
+    su primer archivo.
+    """
+    lotes: Dict[str, List[str]] = {}
+    owner: Dict[str, str] = {}
+    actual: Optional[str] = None
+    cerrado = True
+    for nombre in plan:
+        if nombre in skip:
+            continue
+        solo = plan[nombre]["barrier"] or not batchable(scripts[nombre])
+        if cerrado or solo or len(lotes[actual]) >= max_files:
+            actual = nombre
+            lotes[actual] = []
+        lotes[actual].append(nombre)
+        owner[nombre] = actual
+        cerrado = solo
+
+    lplan: Dict[str, dict] = {}
+    for lote, archivos in lotes.items():
+        depends_on = {
+            owner[d] for n in archivos for d in plan[n]["depends_on"]
+            if d not in skip and owner[d] != lote
+        }
+        lplan[lote] = {
+            "depends_on": depends_on,
+            "barrier": any(plan[n]["barrier"] for n in archivos),
+        }
+    return lotes, lplan
+
+
+def critical_path(plan: Dict[str, dict], durations_ms: Dict[str, int]) -> Tuple[List[str], int]:
+    """Camino más largo del DAG según las duraciones reales; (archivos, ms totales)."""
+    mejor: Dict[str, Tuple[int, Optional[str]]] = {}
+    for nombre in plan:  # el plan está en orden natural, las dependencias siempre son anteriores
+        previo = max(plan[nombre]["depends_on"], key=lambda d: mejor[d][0], default=None)
+        base = mejor[previo][0] if previo else 0
+        mejor[nombre] = (base + durations_ms.get(nombre, 0), previo)
+    if not mejor:
+        return [], 0
+    fin = max(mejor, key=lambda n: mejor[n][0])
+    camino, actual = [], fin
+    while actual:
+        camino.append(actual)
+        actual = mejor[actual][1]
+    return list(reversed(camino)), mejor[fin][0]
@@ -0,0 +1,84 @@
+"""Perfilado de costo de los scripts SQL: estimación por dry-run, estadísticas reales e historial.
+
+Las estadísticas de cada job (bytes procesados/facturados, slot-ms, cache hit) quedan en
+el log JSON de la ejecución; en modo profile además se insertan en una tabla de historial
+de BigQuery y se comparan contra la ejecución anterior del mismo archivo, para detectar
+regresiones (p. ej. un full scan nuevo) en el SQL.
+
+Columnas esperadas en SQL_PROFILE_TABLE: process_name, run_id, file, sha256, status, job_id
+(STRING), dry_run, cache_hit (BOOL), estimated_bytes, total_bytes_processed,
+total_bytes_billed, slot_millis, duration_ms (INT64), started_utc, ended_utc, logged_utc (TIMESTAMP).
+"""
+import os
+from typing import Dict, List, Optional
+
+from google.cloud import bigquery
+
+SQL_PROFILE_TABLE = os.getenv("SQL_PROFILE_TABLE", "deinsoluciones-serverless.dev_config_zone.sql_exec_history")
+
+
+def job_stats(job) -> dict:
+    """Estadísticas de un QueryJob terminado (o dry-run)."""
+    return {
+        "total_bytes_processed": job.total_bytes_processed,
+        "total_bytes_billed": job.total_bytes_billed,
+        "slot_millis": job.slot_millis,
+        "cache_hit": job.cache_hit,
+    }
+
+
+def estimate_bytes(bq_client: bigquery.Client, sql: str) -> dict:
+    """Dry-run del SQL: {"estimated_bytes": int} o {"estimate_error": str}.
+
+    Un dry-run falla si el SQL lee tablas que crea un script anterior del mismo lote y aún no
+    existen; sin estimación, main bloquea el job si hay presupuesto (un lote se ejecuta
+    entonces archivo por archivo, estimando cada uno al lanzarlo).
+    """
+    try:
+        job = bq_client.query(sql, job_config=bigquery.QueryJobConfig(dry_run=True, use_query_cache=False))
+        return {"estimated_bytes": job.total_bytes_processed}
+    except Exception as e:
+        return {"estimate_error": str(e)}
+
+
+def load_previous(bq_client: bigquery.Client, process_name: str, table: str = SQL_PROFILE_TABLE) -> Dict[str, dict]:
+    """Última ejecución real registrada por archivo del proceso: {file: {"total_bytes_processed", ...}}."""
+    query = f"""
+        SELECT file, ARRAY_AGG(STRUCT(run_id, total_bytes_processed, slot_millis)
+                               ORDER BY logged_utc DESC LIMIT 1)[OFFSET(0)] AS last
+        FROM `{table}`
+        WHERE process_name = @process_name AND status = 'done' AND NOT dry_run
+        GROUP BY file
+    """
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[bigquery.ScalarQueryParameter("process_name", "STRING", process_name)]
+    )
+    try:
+        return {row["file"]: dict(row["last"]) for row in bq_client.query(query, job_config=job_config).result()}
+    except Exception as e:
+        print(f"[WARNING] No se pudo leer el historial {table}: {e}")
+        return {}
+
+
+def compare(result: dict, previous: Optional[dict]):
+    """Agrega al resultado los bytes de la ejecución anterior y la variación porcentual."""
+    if not previous or previous.get("total_bytes_processed") is None:
+        return
+    result["previous_bytes_processed"] = previous["total_bytes_processed"]
+    actual = result.get("total_bytes_processed", result.get("estimated_bytes"))
+    if actual is not None and previous["total_bytes_processed"]:
+        result["bytes_change_pct"] = round(
+            (actual - previous["total_bytes_processed"]) * 100.0 / previous["total_bytes_processed"], 1
+        )
+
+
+def write_history(bq_client: bigquery.Client, rows: List[dict], table: str = SQL_PROFILE_TABLE):
+    """Inserta las filas de historial (streaming). Un error no interrumpe la ejecución."""
+    if not rows:
+        return
+    try:
+        errors = bq_client.insert_rows_json(table, rows)
+        if errors:
+            print(f"[WARNING] Errores insertando historial en {table}: {errors}")
+    except Exception as e:
+        print(f"[WARNING] No se pudo escribir el historial en {table}: {e}")
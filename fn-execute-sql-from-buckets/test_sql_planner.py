@@ -0,0 +1,75 @@
+from sql_planner import build_plan, extract_table_refs
+
+PROJECT = "p"
+
+
+def test_apostrofo_en_comentario_no_oculta_escrituras():
+    a = (
+        "INSERT INTO ds.a SELECT * FROM raw.x;\n"
+        "-- it's the daily load\n"
+        "INSERT INTO ds.b SELECT * FROM ds.c WHERE k = 'v';"
+    )
+    b = "CREATE OR REPLACE TABLE ds.report AS SELECT * FROM ds.b"
+    plan = build_plan([("01_a.sql", a), ("02_b.sql", b)], PROJECT)
+    assert plan["01_a.sql"]["writes"] == {"p.ds.a", "p.ds.b"}
+    assert plan["02_b.sql"]["depends_on"] == {"01_a.sql"}
+
+
+def test_comentarios_dentro_de_strings_se_ignoran():
+    sql = "INSERT INTO ds.a SELECT '-- no' AS x, '/* tampoco' AS y FROM ds.src"
+    reads, writes, opaco = extract_table_refs(sql, PROJECT)
+    assert writes == {"p.ds.a"}
+    assert reads == {"p.ds.src"}
+    assert not opaco
+
+
+def test_referencias_en_comentarios_y_strings_no_cuentan():
+    sql = (
+        "/* INSERT INTO ds.fantasma */\n"
+        "# DELETE FROM ds.otro\n"
+        "SELECT 'FROM ds.texto' FROM `p.ds.real`"
+    )
+    reads, writes, _ = extract_table_refs(sql, PROJECT)
+    assert writes == set()
+    assert reads == {"p.ds.real"}
+
+
+def test_comma_join_lee_todas_las_tablas():
+    scripts = [
+        ("01.sql", "CREATE OR REPLACE TABLE ds.b AS SELECT 1 AS x FROM ds.src"),
+        ("02.sql", "INSERT INTO ds.a SELECT * FROM ds.src2"),
+        ("03.sql", "INSERT INTO ds.r SELECT * FROM ds.a, ds.b"),
+    ]
+    plan = build_plan(scripts, PROJECT)
+    assert plan["03.sql"]["reads"] == {"p.ds.a", "p.ds.b"}
+    assert plan["03.sql"]["depends_on"] == {"01.sql", "02.sql"}
+    assert not plan["03.sql"]["barrier"]
+
+
+def test_comma_join_con_alias_subconsulta_y_unnest():
+    sql = (
+        "INSERT INTO ds.r SELECT * FROM (SELECT * FROM ds.a) AS x, ds.b AS b, `p.ds.c` c, "
+        "UNNEST(b.arr) AS v WHERE EXTRACT(DAY FROM x.fecha) = 1 AND x.k IS DISTINCT FROM 2"
+    )
+    reads, writes, opaco = extract_table_refs(sql, PROJECT)
+    assert reads == {"p.ds.a", "p.ds.b", "p.ds.c"}
+    assert writes == {"p.ds.r"}
+    assert not opaco
+
+
+def test_clone_like_copy_son_lecturas():
+    for verbo in ("CLONE", "LIKE", "COPY"):
+        reads, writes, _ = extract_table_refs(f"CREATE TABLE ds.nueva {verbo} ds.origen", PROJECT)
+        assert reads == {"p.ds.origen"}
+        assert writes == {"p.ds.nueva"}
+
+
+def test_identificador_con_backticks_por_parte():
+    reads, writes, _ = extract_table_refs("INSERT INTO `p`.`ds`.`t` SELECT * FROM `q`.`ds2`.`u`", PROJECT)
+    assert writes == {"p.ds.t"}
+    assert reads == {"q.ds2.u"}
+
+
+def test_lista_from_no_reconocida_es_barrera():
+    plan = build_plan([("01.sql", "INSERT INTO ds.r SELECT * FROM ds.a, @tabla")], PROJECT)
+    assert plan["01.sql"]["barrier"]
@@ -4,6 +4,8 @@ from datetime import datetime
 import os
 import re
 
+from config_resolver import resolve_params
+
 
 def _to_bool(val, default=False):
     if val is None:
@@ -40,32 +42,11 @@ def cargar_csv_a_bigquery(request):
         bq_client = bigquery.Client()
         storage_client = storage.Client()
 
-        # 1) Obtener parámetros desde BigQuery
-        param_query = """
-            SELECT params
-            FROM `deinsoluciones-serverless.dev_config_zone.process_params`
-            WHERE process_name = @process_name
-              AND process_fn_name = @process_fn_name
-              AND arquetype_name = @arquetype_name
-              AND active = TRUE
-            LIMIT 1
-        """
-        job_config = bigquery.QueryJobConfig(
-            query_parameters=[
-                bigquery.ScalarQueryParameter("process_name", "STRING", process_name),
-                bigquery.ScalarQueryParameter("process_fn_name", "STRING", process_fn_name),
-                bigquery.ScalarQueryParameter("arquetype_name", "STRING", arquetype_name),
-            ]
-        )
-        result = bq_client.query(param_query, job_config=job_config).result()
-        row = next(iter(result), None)
-        if not row:
+        # 1) Obtener parámetros desde BigQuery (con caché por instancia)
+        params_list = resolve_params(process_name, process_fn_name, arquetype_name, client=bq_client)
+        if not params_list:
             return {"error": "No se encontraron parámetros activos para la combinación solicitada."}, 404
 
-        params_list = row["params"]
-        if not params_list or not isinstance(params_list, list):
-            return {"error": "Formato de 'params' inválido (se esperaba una lista con al menos un objeto)."}, 400
-
         params = params_list[0]
 
         input_uri    = params.get("input")              # gs://bucket/ruta/archivo.csv o prefijo
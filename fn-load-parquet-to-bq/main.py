@@ -4,6 +4,8 @@ import json
 from datetime import datetime
 import os
 
+from config_resolver import resolve_params
+
 @functions_framework.http
 def cargar_parquet_a_bigquery(request):
     try:
@@ -20,32 +22,11 @@ def cargar_parquet_a_bigquery(request):
 
         bq_client = bigquery.Client()
 
-        # 1. Obtener parámetros desde la tabla
-        param_query = f"""
-            SELECT params
-            FROM `deinsoluciones-serverless.dev_config_zone.process_params`
-            WHERE process_name = @process_name
-            AND process_fn_name = @process_fn_name
-            AND arquetype_name = @arquetype_name
-            AND active = TRUE
-        """
-        job_config = bigquery.QueryJobConfig(
-            query_parameters=[
-                bigquery.ScalarQueryParameter("process_name", "STRING", process_name),
-                bigquery.ScalarQueryParameter("process_fn_name", "STRING", process_fn_name),
-                bigquery.ScalarQueryParameter("arquetype_name", "STRING", arquetype_name)
-            ]
-        )
-        result = bq_client.query(param_query, job_config=job_config).result()
-        row = next(iter(result), None)
-
-        if not row:
+        # 1. Obtener parámetros desde la tabla (con caché por instancia)
+        params_list = resolve_params(process_name, process_fn_name, arquetype_name, client=bq_client)
+        if not params_list:
             return {"error": "No se encontraron parámetros activos"}, 404
 
-        params_list = row["params"]
-        if not params_list or not isinstance(params_list, list):
-            return {"error": "Formato de parámetros inválido"}, 400
-
         params = params_list[0]
         input_uri = params.get("input")
         output_table = params.get("output")
@@ -2,14 +2,170 @@ import os
 import json
 from datetime import datetime
 import functions_framework
-from google.cloud import storage, bigquery
-import pandas as pd
-from io import BytesIO
+from google.api_core import exceptions as gcs_exceptions
+from google.cloud import storage
+import pyarrow as pa
+import pyarrow.parquet as pq
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from config_resolver import resolve_params
 
 # Valores fijos (puedes mover a variables de entorno si quieres)
 BUCKET_ORIGEN = "dev-deinsoluciones-ingestas"
 BUCKET_DESTINO = "dev-deinsoluciones-ingestas"
 
+# Columna de fecha según periodicidad
+CAMPOS_FECHA = {"diaria": "periodo_dia", "mensual": "periodo_mes"}
+PARQUET_MAGIC = b"PAR1"
+FOOTER_READ_SIZE = 64 * 1024
+# Tamaño de lectura por rango cuando hay que leer la columna (fallback sin estadísticas)
+COLUMN_READ_CHUNK_SIZE = 1024 * 1024
+# Movimientos concurrentes; el pool HTTP del cliente GCS es de 10 conexiones
+DEFAULT_MAX_WORKERS = int(os.getenv("MOVE_MAX_WORKERS", "8"))
+MAX_WORKERS_LIMIT = 10
+# Límite de operaciones por request batch de GCS
+GCS_BATCH_SIZE = 100
+
+class FechaArchivoError(ValueError):
+    """El archivo no permite determinar una única fecha de partición."""
+
+def read_parquet_footer(blob):
+    """Lee solo el footer de un Parquet con lecturas por rango (no descarga datos de columnas)."""
+    size = blob.size
+    if size is None or size < 12:
+        raise FechaArchivoError(f"Archivo demasiado pequeño para ser Parquet ({size} bytes)")
+
+    tail = blob.download_as_bytes(start=max(0, size - FOOTER_READ_SIZE), end=size - 1, checksum=None)
+    if tail[-4:] != PARQUET_MAGIC:
+        raise FechaArchivoError("El archivo no termina con la firma PAR1 (no es Parquet válido)")
+
+    footer_len = struct.unpack("<I", tail[-8:-4])[0]
+    if footer_len + 8 > size:
+        raise FechaArchivoError(f"Largo de footer inválido ({footer_len} bytes)")
+    if footer_len + 8 > len(tail):
+        tail = blob.download_as_bytes(start=size - footer_len - 8, end=size - 1, checksum=None)
+
+    return pq.read_metadata(pa.BufferReader(tail[-(footer_len + 8):]))
+
+def _formatear_fecha(valor):
+    return valor if isinstance(valor, str) else valor.strftime("%Y-%m-%d")
+
+def _fecha_desde_estadisticas(metadata, col_idx):
+    """Retorna el valor único de la columna usando min/max de cada row group, o None si faltan estadísticas."""
+    minimos, maximos = [], []
+    for rg in range(metadata.num_row_groups):
+        stats = metadata.row_group(rg).column(col_idx).statistics
+        if stats is None or not stats.has_min_max:
+            return None
+        minimos.append(stats.min)
+        maximos.append(stats.max)
+    if not minimos:
+        return None
+    return min(minimos), max(maximos)
+
+def _fecha_desde_columna(blob, campo):
+    """Fallback: lee solo la columna de fecha del primer row group."""
+    with blob.open("rb", chunk_size=COLUMN_READ_CHUNK_SIZE) as f:
+        columna = pq.ParquetFile(f).read_row_group(0, columns=[campo]).column(0)
+    valores = columna.unique().drop_null().to_pylist()
+    if not valores:
+        raise FechaArchivoError(f"La columna '{campo}' no tiene valores")
+    return min(valores), max(valores)
+
+def obtener_fecha_parquet(blob, campo):
+    """Determina la fecha de partición de un Parquet leyendo footer/estadísticas, sin descargar el archivo."""
+    blob.reload()
+    metadata = read_parquet_footer(blob)
+    nombres = metadata.schema.names
+    if campo not in nombres:
+        raise FechaArchivoError(f"Campo de fecha '{campo}' no encontrado en el archivo")
+
+    rango = _fecha_desde_estadisticas(metadata, nombres.index(campo))
+    if rango is None:
+        print(f"⚠️ Sin estadísticas min/max para '{campo}', se lee la columna del primer row group")
+        rango = _fecha_desde_columna(blob, campo)
+
+    minimo, maximo = rango
+    if minimo != maximo:
+        raise FechaArchivoError(
+            f"El archivo contiene más de una fecha en '{campo}' (min={minimo}, max={maximo})"
+        )
+    return _formatear_fecha(minimo)
+
+def _resolver_destino(bucket_src, p):
+    """Retorna (blob origen, path destino) de una entrada de params, resolviendo la fecha."""
+    path_origen = p["path_origen"].rstrip("/")
+    path_destino = p["path_destino"].rstrip("/")
+    nombre_archivo = p["nombre_archivo"]
+    periodicidad = p["periodicidad"].lower()
+
+    full_path_origen = f"{path_origen}/{nombre_archivo}"
+    blob_src = bucket_src.blob(full_path_origen)
+
+    nombre_base, extension = os.path.splitext(nombre_archivo)
+
+    # Determinar la fecha según periodicidad
+    if periodicidad == "esporadica":
+        fecha_str = datetime.now().strftime("%Y-%m-%d")
+    else:
+        campo = CAMPOS_FECHA.get(periodicidad)
+        if not campo:
+            raise FechaArchivoError(f"Campo de fecha no encontrado para periodicidad '{periodicidad}'")
+        try:
+            fecha_str = obtener_fecha_parquet(blob_src, campo)
+        except FechaArchivoError as e:
+            raise FechaArchivoError(f"{full_path_origen}: {e}") from e
+
+    nuevo_nombre = f"{nombre_base}_{fecha_str}{extension}"
+    return blob_src, f"{path_destino}/{nuevo_nombre}"
+
+def mover_blob(blob_src, bucket_dst, full_path_destino):
+    """Copia server-side con la API rewrite, siguiendo el token hasta completar objetos grandes."""
+    start = time.monotonic()
+    blob_dst = bucket_dst.blob(full_path_destino)
+    llamadas = 1
+    token, bytes_reescritos, total_bytes = blob_dst.rewrite(blob_src)
+    while token is not None:
+        llamadas += 1
+        token, bytes_reescritos, total_bytes = blob_dst.rewrite(blob_src, token=token)
+    return {
+        "bytes": total_bytes,
+        "rewrite_calls": llamadas,
+        "duration_ms": int((time.monotonic() - start) * 1000),
+    }
+
+def eliminar_en_batch(client, blobs):
+    """Elimina los blobs en requests batch de GCS (máximo 100 operaciones por batch).
+
+    Un borrado fallido no interrumpe a los demás ni a los batches siguientes: retorna
+    {nombre del blob: error} con los que no se pudieron borrar.
+    """
+    fallidos = {}
+    for i in range(0, len(blobs), GCS_BATCH_SIZE):
+        lote = blobs[i:i + GCS_BATCH_SIZE]
+        try:
+            with client.batch(raise_exception=False) as batch:
+                for blob in lote:
+                    blob.delete()
+        except Exception as e:
+            # Falló el request batch completo: ningún borrado del lote quedó confirmado
+            fallidos.update({blob.name: str(e) for blob in lote})
+            continue
+        # Las respuestas vienen en el mismo orden en que se agregaron los borrados
+        for blob, respuesta in zip(lote, batch._responses):
+            if not 200 <= respuesta.status_code < 300:
+                fallidos[blob.name] = str(gcs_exceptions.from_http_response(respuesta))
+    return fallidos
+
+def _resolve_max_workers(value):
+    try:
+        n = int(value)
+    except (TypeError, ValueError):
+        n = DEFAULT_MAX_WORKERS
+    return max(1, min(n, MAX_WORKERS_LIMIT))
+
 @functions_framework.http
 def mover_archivo_gcs(request):
     try:
@@ -17,88 +173,63 @@ def mover_archivo_gcs(request):
         process_name = request_json.get("process_name")
         process_fn_name = request_json.get("process_fn_name")
         arquetype_name = request_json.get("arquetype_name")
+        max_workers = _resolve_max_workers(request_json.get("max_workers", DEFAULT_MAX_WORKERS))
 
         if not process_name or not process_fn_name:
             return {"error": "Faltan 'process_name' ,  'process_fn_name' O 'arquetype_name' "}, 400
 
-        bq = bigquery.Client()
-        query = f"""
-            SELECT params
-            FROM `deinsoluciones-serverless.dev_config_zone.process_params`
-            WHERE process_name = @process_name
-            AND process_fn_name = @process_fn_name
-            AND arquetype_name = @arquetype_name
-            AND active = TRUE
-        """
-        job_config = bigquery.QueryJobConfig(
-            query_parameters=[
-                bigquery.ScalarQueryParameter("process_name", "STRING", process_name),
-                bigquery.ScalarQueryParameter("process_fn_name", "STRING", process_fn_name),
-                bigquery.ScalarQueryParameter("arquetype_name", "STRING", arquetype_name)
-            ]
-        )
-
-        results = list(bq.query(query, job_config=job_config).result())
-        if not results:
+        params = resolve_params(process_name, process_fn_name, arquetype_name)
+        if not params:
             return {"error": "No se encontraron parámetros activos para el proceso"}, 404
 
-        row = results[0]
-        params = row["params"]
-
-        if not isinstance(params, list):
-            params = [params]
-
         client = storage.Client()
         bucket_src = client.bucket(BUCKET_ORIGEN)
         bucket_dst = client.bucket(BUCKET_DESTINO)
 
-        resultados = []
-        for p in params:
-            path_origen = p["path_origen"].rstrip("/")
-            path_destino = p["path_destino"].rstrip("/")
-            nombre_archivo = p["nombre_archivo"]
-            periodicidad = p["periodicidad"].lower()
-
-            full_path_origen = f"{path_origen}/{nombre_archivo}"
-            blob_src = bucket_src.blob(full_path_origen)
-
-            nombre_base, extension = os.path.splitext(nombre_archivo)
-
-            # Determinar la fecha según periodicidad
-            if periodicidad == "esporadica":
-                fecha_str = datetime.now().strftime("%Y-%m-%d")
-            else:
-                parquet_data = blob_src.download_as_bytes()
-                df = pd.read_parquet(BytesIO(parquet_data))
-
-                if periodicidad == "diaria" and "periodo_dia" in df.columns:
-                    fecha_valor = df["periodo_dia"].unique()[0]
-                elif periodicidad == "mensual" and "periodo_mes" in df.columns:
-                    fecha_valor = df["periodo_mes"].unique()[0]
-                else:
-                    return {"error": f"Campo de fecha no encontrado para periodicidad '{periodicidad}'"}, 400
-
-                fecha_str = (
-                    fecha_valor if isinstance(fecha_valor, str)
-                    else fecha_valor.strftime("%Y-%m-%d")
-                )
-
-            nuevo_nombre = f"{nombre_base}_{fecha_str}{extension}"
-            full_path_destino = f"{path_destino}/{nuevo_nombre}"
-
-            bucket_src.copy_blob(blob_src, bucket_dst, full_path_destino)
-            blob_src.delete()
-
-            resultados.append({
-                "archivo": nombre_archivo,
-                "nuevo_path": f"gs://{BUCKET_DESTINO}/{full_path_destino}",
-                "status": "OK"
-            })
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # 1) Resolver destinos antes de mover nada: un error de fecha no deja movimientos a medias
+            try:
+                movimientos = list(executor.map(lambda p: _resolver_destino(bucket_src, p), params))
+            except FechaArchivoError as e:
+                return {"error": str(e)}, 400
+
+            # 2) Copias server-side en paralelo
+            futures = [
+                executor.submit(mover_blob, blob_src, bucket_dst, full_path_destino)
+                for blob_src, full_path_destino in movimientos
+            ]
 
+            resultados = []
+            copiados = []
+            for (blob_src, full_path_destino), future in zip(movimientos, futures):
+                resultado = {
+                    "archivo": os.path.basename(blob_src.name),
+                    "nuevo_path": f"gs://{BUCKET_DESTINO}/{full_path_destino}",
+                }
+                try:
+                    resultado.update(future.result())
+                    resultado["status"] = "OK"
+                    copiados.append((blob_src, resultado))
+                except Exception as e:
+                    resultado.update({"status": "ERROR", "error": str(e)})
+                resultados.append(resultado)
+
+        # 3) Borrar los originales copiados en un solo batch
+        fallidos = eliminar_en_batch(client, [blob_src for blob_src, _ in copiados])
+        for blob_src, resultado in copiados:
+            if blob_src.name in fallidos:
+                print(f"❌ No se pudo borrar gs://{BUCKET_ORIGEN}/{blob_src.name}: {fallidos[blob_src.name]}")
+                resultado.update({
+                    "status": "ERROR",
+                    "error": f"Copiado a destino, pero no se pudo borrar el original: {fallidos[blob_src.name]}",
+                })
+
+        ok = all(r["status"] == "OK" for r in resultados)
         return {
-            "message": "Archivos procesados correctamente",
+            "message": "Archivos procesados correctamente" if ok else "Algunos archivos no se pudieron mover",
+            "total_bytes": sum(r.get("bytes", 0) for r in resultados),
             "resultados": resultados
-        }, 200
+        }, 200 if ok else 207
 
     except Exception as e:
         return {"error": f"Error inesperado: {str(e)}"}, 500
@@ -0,0 +1,194 @@
+"""Cliente HTTP compartido para las llamadas a APIs externas.
+
+Una sola requests.Session con pool de conexiones (keep-alive) reutilizada entre
+entradas y entre invocaciones "warm", timeouts explícitos y reintentos con backoff
+exponencial + jitter para 429/5xx y errores de red. Las llamadas concurrentes se
+limitan por host para no saturar a un mismo proveedor.
+"""
+import os
+import random
+import threading
+import time
+from typing import Dict, Optional
+from urllib.parse import parse_qsl, urlencode, urljoin, urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+CONNECT_TIMEOUT = float(os.getenv("API_CONNECT_TIMEOUT", "5"))
+READ_TIMEOUT = float(os.getenv("API_READ_TIMEOUT", "30"))
+MAX_RETRIES = int(os.getenv("API_MAX_RETRIES", "3"))
+BACKOFF_BASE = float(os.getenv("API_BACKOFF_BASE", "0.5"))
+BACKOFF_MAX = float(os.getenv("API_BACKOFF_MAX", "20"))
+MAX_PER_HOST = int(os.getenv("API_MAX_PER_HOST", "4"))
+POOL_MAXSIZE = int(os.getenv("API_POOL_MAXSIZE", "16"))
+RETRY_STATUS = {429, 500, 502, 503, 504}
+PAGINATION_TYPES = {"cursor", "offset", "page", "link"}
+
+_lock = threading.Lock()
+_session: Optional[requests.Session] = None
+_hosts: Dict[str, threading.BoundedSemaphore] = {}
+
+
+def get_session() -> requests.Session:
+    global _session
+    with _lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=POOL_MAXSIZE, pool_maxsize=POOL_MAXSIZE)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _session = session
+        return _session
+
+
+def _host_slot(url: str) -> threading.BoundedSemaphore:
+    host = urlsplit(url).netloc.lower()
+    with _lock:
+        if host not in _hosts:
+            _hosts[host] = threading.BoundedSemaphore(MAX_PER_HOST)
+        return _hosts[host]
+
+
+def _espera(intento: int, response: Optional[requests.Response]) -> float:
+    """Backoff exponencial con jitter; respeta Retry-After (en segundos) si la API lo envía."""
+    if response is not None:
+        retry_after = response.headers.get("Retry-After")
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), BACKOFF_MAX)
+    return min(BACKOFF_MAX, BACKOFF_BASE * (2 ** intento)) * random.uniform(0.5, 1.0)
+
+
+def fetch(url: str, timeout=None, max_retries: int = MAX_RETRIES, headers: Optional[dict] = None) -> dict:
+    """GET con reintentos. Nunca lanza: retorna un dict con el resultado de la llamada.
+
+    {"response": Response | None, "error": str | None, "attempts": int, "latency_ms": int}
+    latency_ms es el tiempo total incluyendo reintentos y esperas.
+    """
+    timeout = timeout or (CONNECT_TIMEOUT, READ_TIMEOUT)
+    session = get_session()
+    start = time.monotonic()
+    response, error = None, None
+    intento = 0
+    while True:
+        intento += 1
+        response, error = None, None
+        try:
+            with _host_slot(url):
+                response = session.get(url, timeout=timeout, headers=headers)
+            if response.status_code not in RETRY_STATUS:
+                break
+            error = f"HTTP {response.status_code}"
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+            error = f"{type(e).__name__}: {e}"
+        except requests.RequestException as e:
+            # URL inválida, demasiados redirects, etc.: reintentar no cambia el resultado
+            error = f"{type(e).__name__}: {e}"
+            break
+        if intento > max_retries:
+            break
+        espera = _espera(intento - 1, response)
+        print(f"🔁 {url} falló ({error}); reintento {intento}/{max_retries} en {espera:.1f}s")
+        time.sleep(espera)
+
+    return {
+        "response": response,
+        "error": error,
+        "attempts": intento,
+        "latency_ms": int((time.monotonic() - start) * 1000),
+    }
+
+
+class PageError(RuntimeError):
+    """Una página no se pudo obtener después de los reintentos."""
+
+    def __init__(self, url: str, llamada: dict):
+        response = llamada["response"]
+        detalle = llamada["error"] if response is None else f"HTTP {response.status_code}"
+        super().__init__(f"Falló la página {url}: {detalle}")
+        self.llamada = llamada
+
+
+def with_query(url: str, params: dict) -> str:
+    """Agrega/reemplaza parámetros de query en la URL."""
+    partes = urlsplit(url)
+    query = dict(parse_qsl(partes.query, keep_blank_values=True))
+    query.update({k: v for k, v in params.items() if v is not None})
+    return partes._replace(query=urlencode(query)).geturl()
+
+
+def get_path(data, path: str):
+    """Lee un campo anidado con notación de puntos ('data.items'); None si no existe."""
+    for parte in path.split("."):
+        if not isinstance(data, dict):
+            return None
+        data = data.get(parte)
+    return data
+
+
+def iter_pages(url: str, pagination: dict, records_field: str = "serie", timeout=None):
+    """Recorre la API página a página y entrega (data, records, llamada) por cada respuesta 200.
+
+    Estrategias (pagination["type"]):
+      cursor  cursor_param (cursor) + cursor_field con el próximo cursor en el body
+      offset  offset_param (offset) / limit_param (limit) / limit / start
+      page    page_param (page) / start (1) y opcionalmente limit_param + limit
+      link    header Link rel="next", o next_field con la URL en el body
+    Termina cuando no hay siguiente página, llega una página vacía o se alcanza max_pages.
+    Si una página falla después de los reintentos lanza PageError.
+    """
+    tipo = (pagination.get("type") or "").lower()
+    if tipo not in PAGINATION_TYPES:
+        raise ValueError(f"Tipo de paginación no soportado: {tipo}")
+    max_pages = int(pagination.get("max_pages") or 0)
+    limit = int(pagination.get("limit") or 0) or None
+
+    if tipo == "offset":
+        posicion = int(pagination.get("start") or 0)
+    elif tipo == "page":
+        posicion = int(pagination.get("start") or 1)
+    else:
+        posicion = pagination.get("start")
+
+    siguiente = url
+    paginas = 0
+    while siguiente:
+        if tipo == "offset":
+            page_url = with_query(url, {pagination.get("offset_param", "offset"): posicion,
+                                        pagination.get("limit_param", "limit"): limit})
+        elif tipo == "page":
+            page_url = with_query(url, {pagination.get("page_param", "page"): posicion,
+                                        pagination.get("limit_param", "limit"): limit})
+        elif tipo == "cursor":
+            page_url = with_query(url, {pagination.get("cursor_param", "cursor"): posicion}) if posicion else url
+        else:
+            page_url = siguiente
+
+        llamada = fetch(page_url, timeout=timeout)
+        response = llamada["response"]
+        if response is None or response.status_code != 200:
+            raise PageError(page_url, llamada)
+        data = response.json()
+        records = get_path(data, records_field) or []
+        paginas += 1
+        yield data, records, llamada
+
+        if not records or (max_pages and paginas >= max_pages):
+            return
+        if tipo == "offset":
+            if limit and len(records) < limit:
+                return
+            posicion += len(records)
+        elif tipo == "page":
+            if limit and len(records) < limit:
+                return
+            posicion += 1
+        elif tipo == "cursor":
+            cursor = get_path(data, pagination.get("cursor_field", "next_cursor"))
+            if not cursor or cursor == posicion:
+                return
+            posicion = cursor
+        else:
+            next_field = pagination.get("next_field")
+            next_url = get_path(data, next_field) if next_field else response.links.get("next", {}).get("url")
+            siguiente = urljoin(page_url, next_url) if next_url else None
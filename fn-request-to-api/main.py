@@ -1,12 +1,28 @@
 import functions_framework
-import requests
+import hashlib
+import io
 import json
-import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 from google.cloud import storage, bigquery
-from datetime import datetime
+from datetime import datetime, timezone
 import os
+from concurrent.futures import ThreadPoolExecutor
+
+from fetch_engine import PageError, fetch, iter_pages
 
 BUCKET_NAME = "dev-deinsoluciones-ingestas"
+# Entradas procesadas en paralelo; el tope respeta el pool HTTP de storage.Client (10 conexiones)
+API_MAX_WORKERS = max(1, min(int(os.getenv("API_MAX_WORKERS", "8")), 10))
+# APIs paginadas: filas por row group del Parquet y tamaño de chunk del upload resumable
+DEFAULT_ROW_GROUP_ROWS = int(os.getenv("API_ROW_GROUP_ROWS", "100000"))
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+# Metadata del Parquet en GCS usada como caché HTTP de la URL de origen
+META_SOURCE_URL = "source_url"
+META_HTTP_ETAG = "http_etag"
+META_HTTP_LAST_MODIFIED = "http_last_modified"
+META_CONTENT_HASH = "content_sha256"
+META_CONFIG_HASH = "config_sha256"
 
 def parse_vars(vars_str):
     serie_fields = []
@@ -18,6 +34,281 @@ def parse_vars(vars_str):
             flat_fields.append(item)
     return flat_fields, serie_fields
 
+def parse_fecha(valor):
+    """ISO 8601 ('2024-05-10T04:00:00.000Z' o '2024-05-10') -> date, en UTC si trae zona."""
+    if valor is None:
+        return None
+    dt = datetime.fromisoformat(str(valor).replace("Z", "+00:00"))
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc)
+    return dt.date()
+
+def tipo_arrow(valores):
+    """Tipo Arrow explícito para una columna según los valores JSON (int/float/bool/str)."""
+    presentes = [v for v in valores if v is not None]
+    if not presentes:
+        return pa.string()
+    if all(isinstance(v, bool) for v in presentes):
+        return pa.bool_()
+    if all(isinstance(v, int) and not isinstance(v, bool) for v in presentes):
+        return pa.int64()
+    if all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in presentes):
+        return pa.float64()
+    return pa.string()
+
+def columna_arrow(nombre, valores, tipos=None, es_fecha=False):
+    """Construye la columna con su tipo: fecha como date32, override desde params o inferido."""
+    if es_fecha:
+        return pa.field(nombre, pa.date32()), pa.array([parse_fecha(v) for v in valores], type=pa.date32())
+    if tipos and nombre in tipos:
+        tipo = tipos[nombre]
+        tipo = tipo if isinstance(tipo, pa.DataType) else pa.type_for_alias(tipo)
+    else:
+        tipo = tipo_arrow(valores)
+    if pa.types.is_string(tipo):
+        valores = [v if v is None or isinstance(v, str) else json.dumps(v) for v in valores]
+        return pa.field(nombre, tipo), pa.array(valores, type=tipo)
+    if tipos and nombre in tipos:
+        # pa.array(..., type=int64) trunca los float sin avisar: se infiere y se castea en modo safe
+        return pa.field(nombre, tipo), pa.array(valores).cast(tipo, safe=True)
+    return pa.field(nombre, tipo), pa.array(valores, type=tipo)
+
+def build_table(serie, serie_fields, flat_data, tipos=None):
+    """Arma la tabla Arrow: columnas de 'serie' más los campos planos repetidos en cada fila."""
+    n = len(serie) if serie_fields else 1
+    columnas = [(f, [rec.get(f) for rec in serie], f == "fecha") for f in serie_fields]
+    columnas += [(k, [v] * n, False) for k, v in flat_data.items()]
+    fields, arrays = [], []
+    for nombre, valores, es_fecha in columnas:
+        field, array = columna_arrow(nombre, valores, tipos, es_fecha)
+        fields.append(field)
+        arrays.append(array)
+    return pa.Table.from_arrays(arrays, schema=pa.schema(fields))
+
+def _to_bool(val, default=False):
+    if val is None:
+        return default
+    if isinstance(val, bool):
+        return val
+    if isinstance(val, (int, float)):
+        return val != 0
+    if isinstance(val, str):
+        return val.strip().lower() in {"true", "1", "t", "yes", "y", "si", "sí"}
+    return default
+
+def config_hash(param):
+    """Hash de lo que define el Parquet además de la respuesta (vars, schema): si cambia, se reescribe."""
+    config = json.dumps([param.get("vars"), param.get("schema")], sort_keys=True, default=str)
+    return hashlib.sha256(config.encode("utf-8")).hexdigest()
+
+def conditional_headers(url, blob, config_digest):
+    """If-None-Match / If-Modified-Since a partir de la metadata del Parquet escrito la vez anterior."""
+    metadata = (blob.metadata or {}) if blob is not None else {}
+    if metadata.get(META_SOURCE_URL) != url or metadata.get(META_CONFIG_HASH) != config_digest:
+        return {}
+    headers = {}
+    if metadata.get(META_HTTP_ETAG):
+        headers["If-None-Match"] = metadata[META_HTTP_ETAG]
+    if metadata.get(META_HTTP_LAST_MODIFIED):
+        headers["If-Modified-Since"] = metadata[META_HTTP_LAST_MODIFIED]
+    return headers
+
+def cache_metadata(url, response, digest, config_digest):
+    metadata = {META_SOURCE_URL: url, META_CONTENT_HASH: digest, META_CONFIG_HASH: config_digest}
+    if response.headers.get("ETag"):
+        metadata[META_HTTP_ETAG] = response.headers["ETag"]
+    if response.headers.get("Last-Modified"):
+        metadata[META_HTTP_LAST_MODIFIED] = response.headers["Last-Modified"]
+    return metadata
+
+def procesar_paginado(param, storage_client, filename, flat_fields, serie_fields):
+    """Recorre una API paginada y escribe las filas en un Parquet que se sube mientras llegan páginas.
+
+    Las filas se acumulan hasta row_group_rows y se escriben como un row group, así la memoria
+    queda acotada a un row group y el upload resumable avanza con cada flush. El esquema se fija
+    con el primer row group (mismos tipos que el camino sin paginación). Cada row group siguiente
+    se infiere por separado y se castea al esquema en modo safe: si no calza (p. ej. decimales
+    en una columna que empezó como int64) la entrada falla en vez de truncar valores; en ese
+    caso el tipo se fija con schema en params.
+    """
+    pagination = param["pagination"]
+    records_field = pagination.get("records_field", "serie")
+    if not serie_fields:
+        return {"filename": filename, "status": "ERROR",
+                "error": "La paginación requiere campos 'serie.' en vars"}
+    row_group_rows = max(1, int(param.get("row_group_rows") or DEFAULT_ROW_GROUP_ROWS))
+    filename_ext = filename if filename.endswith(".parquet") else f"{filename}.parquet"
+    destination_path = f"origin-files/{filename_ext}"
+    blob = storage_client.bucket(BUCKET_NAME).blob(destination_path)
+
+    metricas = {"pages": 0, "latency_ms": 0, "attempts": 0, "row_groups": 0}
+    flat_data = None
+    pendientes = []
+    tipos = param.get("schema") or {}
+    writer = None
+    rows = 0
+
+    def flush(sink, filas):
+        nonlocal writer, rows
+        table = build_table(filas, serie_fields, flat_data, tipos)
+        if writer is None:
+            writer = pq.ParquetWriter(sink, table.schema)
+        try:
+            table = table.cast(writer.schema, safe=True)
+        except (pa.ArrowInvalid, pa.ArrowNotImplementedError) as e:
+            raise ValueError(f"El row group {metricas['row_groups'] + 1} no calza con el esquema "
+                             f"(fije el tipo con schema en params): {e}")
+        writer.write_table(table, row_group_size=row_group_rows)
+        metricas["row_groups"] += 1
+        rows += table.num_rows
+
+    try:
+        with blob.open("wb", chunk_size=UPLOAD_CHUNK_SIZE, ignore_flush=True,
+                       content_type="application/octet-stream") as sink:
+            for data, records, llamada in iter_pages(param["url"], pagination, records_field):
+                metricas["pages"] += 1
+                metricas["latency_ms"] += llamada["latency_ms"]
+                metricas["attempts"] += llamada["attempts"]
+                if flat_data is None:
+                    faltantes = [f for f in flat_fields if f not in data]
+                    if faltantes:
+                        raise ValueError(f"Campo plano '{faltantes[0]}' no encontrado")
+                    flat_data = {f: data[f] for f in flat_fields}
+                if records and writer is None and not pendientes:
+                    disponibles = set().union(*(rec.keys() for rec in records))
+                    if not all(f in disponibles for f in serie_fields):
+                        raise ValueError(f"Algunos campos de '{records_field}' no existen")
+                pendientes.extend(records)
+                while len(pendientes) >= row_group_rows:
+                    flush(sink, pendientes[:row_group_rows])
+                    pendientes = pendientes[row_group_rows:]
+            if writer is None and not pendientes:
+                raise ValueError(f"La sección '{records_field}' no está presente o está vacía")
+            if pendientes:
+                flush(sink, pendientes)
+            writer.close()
+            size = sink.tell()
+    except PageError as e:
+        metricas["latency_ms"] += e.llamada["latency_ms"]
+        metricas["attempts"] += e.llamada["attempts"]
+        return {"filename": filename, "status": "ERROR", "error": str(e), **metricas}
+    except ValueError as e:
+        return {"filename": filename, "status": "ERROR", "error": str(e), **metricas}
+
+    return {
+        "filename": filename,
+        "status": "OK",
+        "path": f"gs://{BUCKET_NAME}/{destination_path}",
+        "rows": rows,
+        "bytes": size,
+        **metricas,
+    }
+
+def procesar_param(param, storage_client):
+    """Consulta la API de una entrada de params, arma el DataFrame y lo sube como Parquet."""
+    url = param.get("url")
+    filename = param.get("filename")
+    vars_str = param.get("vars")
+
+    if not url or not filename or not vars_str:
+        return {
+            "filename": filename or "desconocido",
+            "status": "SKIPPED",
+            "error": "Faltan uno o más campos requeridos: url, filename o vars"
+        }
+
+    flat_fields, serie_fields = parse_vars(vars_str)
+    if param.get("pagination"):
+        # Un resultado de varias páginas no se puede revalidar con un solo GET condicional
+        return {**procesar_paginado(param, storage_client, filename, flat_fields, serie_fields), "cache": "BYPASS"}
+
+    filename_ext = filename if filename.endswith(".parquet") else f"{filename}.parquet"
+    destination_path = f"origin-files/{filename_ext}"
+    bucket = storage_client.bucket(BUCKET_NAME)
+    usar_cache = _to_bool(param.get("http_cache"), default=True)
+    existente = bucket.get_blob(destination_path) if usar_cache else None
+    path = f"gs://{BUCKET_NAME}/{destination_path}"
+
+    config_digest = config_hash(param)
+    headers = conditional_headers(url, existente, config_digest)
+    llamada = fetch(url, headers=headers)
+    metricas = {"latency_ms": llamada["latency_ms"], "attempts": llamada["attempts"]}
+    response = llamada["response"]
+    if response is None:
+        return {"filename": filename, "status": "ERROR", "error": f"Error de red: {llamada['error']}", **metricas}
+    if response.status_code == 304 and headers:
+        print(f"⚡ {url} sin cambios (304); se mantiene {path}")
+        return {"filename": filename, "status": "OK", "path": path, "cache": "HIT",
+                "cache_reason": "not_modified", **metricas}
+    if response.status_code != 200:
+        return {"filename": filename, "status": "ERROR", "error": f"Error en la API: {response.status_code}", **metricas}
+
+    digest = hashlib.sha256(response.content).hexdigest()
+    metadata = cache_metadata(url, response, digest, config_digest)
+    previo = (existente.metadata or {}) if existente is not None else {}
+    if previo.get(META_CONTENT_HASH) == digest and previo.get(META_CONFIG_HASH) == config_digest:
+        # Mismo contenido: no se reescribe el Parquet, solo se actualizan los validadores si cambiaron
+        if {k: previo.get(k) for k in metadata} != metadata:
+            existente.metadata = metadata
+            existente.patch()
+        print(f"⚡ {url} con el mismo contenido; se mantiene {path}")
+        return {"filename": filename, "status": "OK", "path": path, "cache": "HIT",
+                "cache_reason": "same_content", **metricas}
+
+    try:
+        data = response.json()
+    except ValueError as e:
+        return {"filename": filename, "status": "ERROR", "error": f"La respuesta no es JSON válido: {e}", **metricas}
+
+    flat_data = {}
+    for field in flat_fields:
+        if field not in data:
+            return {"filename": filename, "status": "ERROR", "error": f"Campo plano '{field}' no encontrado", **metricas}
+        flat_data[field] = data[field]
+
+    serie = []
+    if serie_fields:
+        if "serie" not in data or not data["serie"]:
+            return {"filename": filename, "status": "ERROR", "error": "La sección 'serie' no está presente o está vacía", **metricas}
+        serie = data["serie"]
+        disponibles = set().union(*(rec.keys() for rec in serie))
+        if not all(f in disponibles for f in serie_fields):
+            return {"filename": filename, "status": "ERROR", "error": "Algunos campos de 'serie' no existen", **metricas}
+
+    try:
+        table = build_table(serie, serie_fields, flat_data, param.get("schema"))
+    except (ValueError, pa.ArrowNotImplementedError) as e:
+        # Incluye pa.ArrowInvalid y fechas que no son ISO 8601 (parse_fecha)
+        return {"filename": filename, "status": "ERROR", "error": f"No se pudo armar la tabla: {e}", **metricas}
+
+    # El Parquet se arma en memoria y se sube directo, sin pasar por /tmp
+    buffer = io.BytesIO()
+    pq.write_table(table, buffer)
+    size = buffer.tell()
+    buffer.seek(0)
+    blob = bucket.blob(destination_path)
+    blob.metadata = metadata
+    blob.upload_from_file(buffer, size=size, content_type="application/octet-stream")
+
+    return {
+        "filename": filename,
+        "status": "OK",
+        "path": path,
+        "rows": table.num_rows,
+        "bytes": size,
+        "cache": "MISS",
+        **metricas,
+    }
+
+def procesar_param_seguro(param, storage_client):
+    """procesar_param que nunca lanza: un error inesperado queda como ERROR de esa entrada."""
+    try:
+        return procesar_param(param, storage_client)
+    except Exception as e:
+        filename = param.get("filename") if isinstance(param, dict) else None
+        print(f"❌ Error procesando {filename}: {e}")
+        return {"filename": filename or "desconocido", "status": "ERROR", "error": f"Error inesperado: {e}"}
+
 @functions_framework.http
 def fetch_and_store_mindicador(request):
     try:
@@ -58,71 +349,10 @@ def fetch_and_store_mindicador(request):
             return {"error": "El campo 'params' debe ser una lista"}, 400
 
         storage_client = storage.Client()
-        resultados = []
-
-        for param in param_list:
-            url = param.get("url")
-            filename = param.get("filename")
-            vars_str = param.get("vars")
-
-            if not url or not filename or not vars_str:
-                resultados.append({
-                    "filename": filename or "desconocido",
-                    "status": "SKIPPED",
-                    "error": "Faltan uno o más campos requeridos: url, filename o vars"
-                })
-                continue
-
-            flat_fields, serie_fields = parse_vars(vars_str)
-            response = requests.get(url)
-            if response.status_code != 200:
-                resultados.append({
-                    "filename": filename,
-                    "status": "ERROR",
-                    "error": f"Error en la API: {response.status_code}"
-                })
-                continue
-
-            data = response.json()
-
-            flat_data = {}
-            for field in flat_fields:
-                if field not in data:
-                    resultados.append({"filename": filename, "status": "ERROR", "error": f"Campo plano '{field}' no encontrado"})
-                    break
-                flat_data[field] = data[field]
-            else:
-                if serie_fields:
-                    if "serie" not in data or not data["serie"]:
-                        resultados.append({"filename": filename, "status": "ERROR", "error": "La sección 'serie' no está presente o está vacía"})
-                        continue
-                    df = pd.DataFrame(data["serie"])
-                    if not all(f in df.columns for f in serie_fields):
-                        resultados.append({"filename": filename, "status": "ERROR", "error": "Algunos campos de 'serie' no existen"})
-                        continue
-                    df = df[serie_fields]
-                    if "fecha" in df.columns:
-                        df["fecha"] = pd.to_datetime(df["fecha"]).dt.date
-                    for k, v in flat_data.items():
-                        df[k] = v
-                else:
-                    df = pd.DataFrame([flat_data])
-
-                filename_ext = filename if filename.endswith(".parquet") else f"{filename}.parquet"
-                local_path = f"/tmp/{filename_ext}"
-                destination_path = f"origin-files/{filename_ext}"
-
-                df.to_parquet(local_path, engine="pyarrow")
-                bucket = storage_client.bucket(BUCKET_NAME)
-                blob = bucket.blob(destination_path)
-                blob.upload_from_filename(local_path, content_type="application/octet-stream")
-                os.remove(local_path)
-
-                resultados.append({
-                    "filename": filename,
-                    "status": "OK",
-                    "path": f"gs://{BUCKET_NAME}/{destination_path}"
-                })
+        workers = max(1, min(API_MAX_WORKERS, len(param_list)))
+        # Las llamadas a un mismo host quedan limitadas por fetch_engine (API_MAX_PER_HOST)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            resultados = list(executor.map(lambda p: procesar_param_seguro(p, storage_client), param_list))
 
         return {"resultados": resultados}, 200
 
@@ -0,0 +1,154 @@
+"""Resolución de parámetros de dev_config_zone.process_params con caché en memoria.
+
+Cloud Run reutiliza la instancia entre invocaciones, así que guardamos los params
+ya resueltos por (process_name, process_fn_name, arquetype_name) y evitamos un job
+de BigQuery en cada paso del workflow. El caché expira por TTL, se acota por
+tamaño (LRU) y se vacía cuando cambia el timestamp `modified` de la tabla.
+
+Este archivo se copia tal cual en cada función que lo usa (cada carpeta se
+despliega por separado con --source).
+"""
+import copy
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+from google.cloud import bigquery
+
+PROCESS_PARAMS_TABLE = os.getenv(
+    "PROCESS_PARAMS_TABLE", "deinsoluciones-serverless.dev_config_zone.process_params"
+)
+CACHE_TTL_SECONDS = float(os.getenv("PROCESS_PARAMS_CACHE_TTL", "300"))
+CACHE_MAX_ENTRIES = int(os.getenv("PROCESS_PARAMS_CACHE_MAX", "128"))
+# Cada cuánto se consulta la metadata de la tabla (get_table es barato, pero no gratis)
+MODIFIED_CHECK_SECONDS = float(os.getenv("PROCESS_PARAMS_MODIFIED_CHECK", "15"))
+
+_lock = threading.Lock()
+_cache: "OrderedDict[Tuple[str, str, str], Tuple[float, List[dict]]]" = OrderedDict()
+_table_modified = None
+_modified_checked_at = 0.0
+_bq_client: Optional[bigquery.Client] = None
+
+
+def _client() -> bigquery.Client:
+    global _bq_client
+    if _bq_client is None:
+        _bq_client = bigquery.Client()
+    return _bq_client
+
+
+def normalize_params(param_value) -> List[dict]:
+    """Convierte `params` (dict, lista o string JSON) en una lista de dicts."""
+    if param_value is None:
+        return []
+    if isinstance(param_value, str):
+        try:
+            param_value = json.loads(param_value)
+        except ValueError as e:
+            print(f"[ERROR] Falló parseo de params: {e}")
+            return []
+    if isinstance(param_value, dict):
+        return [param_value]
+    if isinstance(param_value, list):
+        out = []
+        for item in param_value:
+            if isinstance(item, str):
+                out.extend(normalize_params(item))
+            elif isinstance(item, dict):
+                out.append(item)
+            else:
+                print(f"[WARNING] Elemento de params no manejado: {type(item)}")
+        return out
+    print(f"[WARNING] Tipo de params no manejado: {type(param_value)}")
+    return []
+
+
+def _check_table_modified(client: bigquery.Client):
+    """Vacía el caché si la tabla de params fue modificada desde la última revisión."""
+    global _table_modified, _modified_checked_at
+    now = time.monotonic()
+    with _lock:
+        if _table_modified is not None and now - _modified_checked_at < MODIFIED_CHECK_SECONDS:
+            return
+    try:
+        modified = client.get_table(PROCESS_PARAMS_TABLE).modified
+    except Exception as e:
+        # Sin metadata no podemos validar: descartamos el caché para no servir datos viejos
+        print(f"[WARNING] No se pudo leer metadata de {PROCESS_PARAMS_TABLE}: {e}")
+        with _lock:
+            _cache.clear()
+            _table_modified = None
+        return
+    with _lock:
+        if _table_modified is not None and modified != _table_modified:
+            print(f"♻️ {PROCESS_PARAMS_TABLE} modificada ({modified}); se invalida el caché")
+            _cache.clear()
+        _table_modified = modified
+        _modified_checked_at = now
+
+
+def _query_params(client: bigquery.Client, process_name: str, process_fn_name: str,
+                  arquetype_name: str) -> List[dict]:
+    query = f"""
+        SELECT params
+        FROM `{PROCESS_PARAMS_TABLE}`
+        WHERE process_name = @process_name
+          AND process_fn_name = @process_fn_name
+          AND arquetype_name = @arquetype_name
+          AND active = TRUE
+    """
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[
+            bigquery.ScalarQueryParameter("process_name", "STRING", process_name),
+            bigquery.ScalarQueryParameter("process_fn_name", "STRING", process_fn_name),
+            bigquery.ScalarQueryParameter("arquetype_name", "STRING", arquetype_name),
+        ]
+    )
+    param_list = []
+    for row in client.query(query, job_config=job_config).result():
+        param_list.extend(normalize_params(row["params"]))
+    return param_list
+
+
+def resolve_params(process_name: str, process_fn_name: str, arquetype_name: str,
+                   client: Optional[bigquery.Client] = None, use_cache: bool = True) -> List[dict]:
+    """Retorna la lista de params activos para la combinación, usando el caché si es posible.
+
+    Siempre retorna una lista de dicts (vacía si no hay params activos). El resultado
+    es una copia, así que el llamador puede modificarlo sin afectar al caché.
+    """
+    client = client or _client()
+    key = (process_name, process_fn_name, arquetype_name)
+
+    if use_cache and CACHE_TTL_SECONDS > 0:
+        _check_table_modified(client)
+        with _lock:
+            entry = _cache.get(key)
+            if entry and time.monotonic() - entry[0] < CACHE_TTL_SECONDS:
+                _cache.move_to_end(key)
+                print(f"⚡ params desde caché para {key}")
+                return copy.deepcopy(entry[1])
+            if entry:
+                del _cache[key]
+
+    param_list = _query_params(client, process_name, process_fn_name, arquetype_name)
+
+    # No se cachean resultados vacíos: una config recién activada debe verse de inmediato
+    if use_cache and CACHE_TTL_SECONDS > 0 and param_list:
+        with _lock:
+            _cache[key] = (time.monotonic(), copy.deepcopy(param_list))
+            _cache.move_to_end(key)
+            while len(_cache) > CACHE_MAX_ENTRIES:
+                _cache.popitem(last=False)
+    return param_list
+
+
+def clear_cache():
+    """Vacía el caché (útil para forzar lectura fresca)."""
+    global _table_modified
+    with _lock:
+        _cache.clear()
+        _table_modified = None
@@ -1,9 +1,199 @@
 import functions_framework
-import paramiko
-from google.cloud import storage, secretmanager, bigquery
+from google.cloud import storage
 import tempfile
 import os
 import json
+import fnmatch
+import posixpath
+import stat
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from config_resolver import resolve_params
+from landing_transform import land_to_gcs, transform_options, transform_to_gcs, written_paths
+from sftp_pool import sftp_connection
+from watermark_store import load_watermark, save_watermark
+
+TRANSFER_MODE_STREAM = "stream"
+TRANSFER_MODE_TEMPFILE = "tempfile"
+# Read-ahead SFTP: bytes pedidos en pipeline por ventana y tamaño de cada lectura entregada
+PREFETCH_WINDOW = int(os.getenv("SFTP_PREFETCH_WINDOW", str(32 * 1024 * 1024)))
+SFTP_READ_SIZE = 1024 * 1024
+SELECTION_LATEST = "latest"
+SELECTION_NEW = "new"
+# Transferencias simultáneas por entrada; cada una usa su propio canal SFTP sobre la misma sesión SSH.
+# El tope respeta el pool HTTP de storage.Client (10 conexiones).
+SFTP_MAX_PARALLEL = int(os.getenv("SFTP_MAX_PARALLEL", "4"))
+SFTP_MAX_PARALLEL_CAP = 8
+
+def _to_bool(val, default=False):
+    if val is None:
+        return default
+    if isinstance(val, bool):
+        return val
+    if isinstance(val, (int, float)):
+        return val != 0
+    if isinstance(val, str):
+        return val.strip().lower() in {"true", "1", "t", "yes", "y", "si", "sí"}
+    return default
+
+def normalize_patterns(value):
+    """Acepta un glob, una lista de globs o un string separado por comas. Sin patrones = todo."""
+    if not value:
+        return ["*"]
+    if isinstance(value, str):
+        value = value.split(",")
+    return [p.strip() for p in value if p and p.strip()] or ["*"]
+
+def list_matching_entries(sftp, remote_dir=".", patterns=("*",)):
+    """Retorna (archivos regulares que calzan con algún patrón, cantidad listada) del directorio remoto.
+
+    SFTP no permite continuar un listado desde un punto, así que se recorre con listdir_iter
+    (READDIR en pipeline) sin armar la lista completa de atributos.
+    """
+    matching = []
+    listados = 0
+    for entry in sftp.listdir_iter(remote_dir):
+        listados += 1
+        if entry.st_mode is not None and not stat.S_ISREG(entry.st_mode):
+            continue
+        if any(fnmatch.fnmatchcase(entry.filename, p) for p in patterns):
+            matching.append(entry)
+    return matching, listados
+
+def select_entries(entries, selection=SELECTION_LATEST, watermark=None, max_files=None, backfill=False):
+    """Elige qué archivos transferir.
+
+    - latest: solo el más reciente (comportamiento original).
+    - new: todos los más nuevos que el watermark, del más antiguo al más nuevo. Los archivos con el
+      mismo mtime del watermark se comparan por nombre, porque dos archivos pueden compartir segundo.
+      Sin watermark (primera ejecución) solo se toma el más reciente, que siembra el watermark;
+      con backfill=True se toma todo el directorio (acotado por max_files).
+    """
+    if not entries:
+        return []
+    last_mtime = (watermark or {}).get("last_mtime")
+    if selection == SELECTION_LATEST or (last_mtime is None and not backfill):
+        return [max(entries, key=lambda e: e.st_mtime)]
+
+    vistos = set((watermark or {}).get("files_at_mtime") or [])
+    if last_mtime is not None:
+        entries = [
+            e for e in entries
+            if e.st_mtime > last_mtime or (e.st_mtime == last_mtime and e.filename not in vistos)
+        ]
+    entries = sorted(entries, key=lambda e: (e.st_mtime, e.filename))
+    if max_files:
+        entries = entries[:max_files]
+    return entries
+
+def advance_watermark(watermark, transferidos):
+    """Avanza el watermark sobre los archivos transferidos en orden, hasta el primero que falló.
+
+    `transferidos` es la lista [(entry, ok)] ordenada por (mtime, nombre). Los archivos posteriores a
+    un fallo quedan fuera para que la siguiente ejecución los reintente.
+    """
+    last_mtime = (watermark or {}).get("last_mtime")
+    files_at_mtime = list((watermark or {}).get("files_at_mtime") or [])
+    for entry, ok in transferidos:
+        if not ok:
+            break
+        if last_mtime is None or entry.st_mtime > last_mtime:
+            last_mtime = entry.st_mtime
+            files_at_mtime = []
+        files_at_mtime.append(entry.filename)
+    if last_mtime is None:
+        return None
+    return {"last_mtime": last_mtime, "files_at_mtime": files_at_mtime}
+
+def watermark_source_id(hostname, port, username, remote_dir, patterns):
+    return f"sftp://{username}@{hostname}:{port}/{remote_dir.strip('/')}?{','.join(sorted(patterns))}"
+
+def resolve_max_parallel(config, pendientes):
+    try:
+        workers = int(config.get("max_parallel") or SFTP_MAX_PARALLEL)
+    except (TypeError, ValueError):
+        workers = SFTP_MAX_PARALLEL
+    return max(1, min(workers, SFTP_MAX_PARALLEL_CAP, pendientes))
+
+def sftp_chunks(sftp_file, size, window=PREFETCH_WINDOW, read_size=SFTP_READ_SIZE):
+    """Lee el archivo remoto por ventanas con read-ahead (readv).
+
+    paramiko.prefetch() pide el archivo completo y guarda en memoria todo lo que llega aunque no
+    se haya consumido; readv por ventanas mantiene las peticiones en pipeline pero acota lo
+    almacenado a `window` bytes.
+    """
+    for inicio in range(0, size, window):
+        fin = min(inicio + window, size)
+        rangos = [(offset, min(read_size, fin - offset)) for offset in range(inicio, fin, read_size)]
+        for data in sftp_file.readv(rangos):
+            yield data
+
+def file_range(sftp_file):
+    """Retorna read_range(offset, length) sobre un SFTPFile (seekable) propio.
+
+    Se usa un handle aparte del de sftp_chunks: su read-ahead (readv) deja pedidos en vuelo
+    atados a la posición del archivo.
+    """
+    def read_range(offset, length):
+        sftp_file.seek(offset)
+        return sftp_file.read(length)
+
+    return read_range
+
+def transfer_sftp_to_gcs(sftp, remote_path, size, blob, mode=TRANSFER_MODE_STREAM, transform=None):
+    """Copia un archivo remoto a GCS y retorna métricas de la transferencia."""
+    start = time.monotonic()
+    extra = {}
+    if mode == TRANSFER_MODE_TEMPFILE:
+        with tempfile.NamedTemporaryFile() as tmp_file:
+            sftp.getfo(remote_path, tmp_file)
+            tmp_file.flush()
+            total = tmp_file.tell()
+            if transform:
+                tmp_file.seek(0)
+                extra = transform_to_gcs(tmp_file, blob, transform)
+            else:
+                blob.upload_from_filename(tmp_file.name)
+    else:
+        with sftp.open(remote_path, "rb") as sftp_file:
+            chunks = sftp_chunks(sftp_file, size)
+            if transform:
+                # Un zip se lee por rangos desde un segundo handle en vez de copiarlo a /tmp
+                with sftp.open(remote_path, "rb") as zip_file:
+                    total, extra = land_to_gcs(
+                        lambda: next(chunks, b""), blob, transform, file_range(zip_file), size
+                    )
+            else:
+                total, extra = land_to_gcs(lambda: next(chunks, b""), blob)
+
+    elapsed = time.monotonic() - start
+    return {
+        "bytes": total,
+        "duration_s": round(elapsed, 3),
+        "throughput_mb_s": round(total / (1024 * 1024) / elapsed, 2) if elapsed > 0 else None,
+        "transfer_mode": mode,
+        **extra,
+    }
+
+def transfer_entry(conexion, remote_dir, entry, blob, mode, canal_propio=False, transform=None):
+    """Transfiere una entrada y retorna sus métricas, o {"error"} si falló.
+
+    Con canal_propio=True se abre un canal SFTP nuevo sobre la sesión SSH compartida: los
+    canales se multiplexan en el mismo transport, sin otro handshake ni autenticación.
+    """
+    remote_path = posixpath.join(remote_dir, entry.filename)
+    sftp = None
+    try:
+        # Abrir el canal puede fallar (límite de sesiones del servidor): cuenta como error del archivo
+        sftp = conexion["ssh"].open_sftp() if canal_propio else conexion["sftp"]
+        return transfer_sftp_to_gcs(sftp, remote_path, entry.st_size, blob, mode, transform)
+    except Exception as e:
+        print(f"❌ Error transfiriendo {remote_path}: {e}")
+        return {"error": str(e)}
+    finally:
+        if canal_propio and sftp is not None:
+            sftp.close()
 
 @functions_framework.http
 def multi_sftp_to_gcs(request):
@@ -17,113 +207,112 @@ def multi_sftp_to_gcs(request):
         return {"error": "Faltan parámetros de consulta"}, 400
 
     try:
-        bq_client = bigquery.Client()
-        query = """
-            SELECT params
-            FROM `deinsoluciones-serverless.dev_config_zone.process_params`
-            WHERE process_name = @process_name
-              AND process_fn_name = @process_fn_name
-              AND arquetype_name = @arquetype_name
-              AND active = TRUE
-        """
-
-        job_config = bigquery.QueryJobConfig(
-            query_parameters=[
-                bigquery.ScalarQueryParameter("process_name", "STRING", process_name),
-                bigquery.ScalarQueryParameter("process_fn_name", "STRING", process_fn_name),
-                bigquery.ScalarQueryParameter("arquetype_name", "STRING", arquetype_name),
-            ]
-        )
-
-        results = bq_client.query(query, job_config=job_config).result()
+        config_list = resolve_params(process_name, process_fn_name, arquetype_name)
+        print("params:", config_list)
+        storage_client = storage.Client()
         count = 0
         archivos_subidos = []
+        detalle = []
+        errores = []
 
-        for row in results:
-            params_raw = row["params"]
-            print("params_raw:", params_raw)
+        for config in config_list:
+            print("Configuración recibida:", config)
 
-            try:
-                config_list = params_raw
-            except Exception as json_error:
-                print("Error al parsear JSON:", str(json_error))
-                continue
+            hostname = config.get("hostname")
+            port = int(config.get("port", 22))
+            username = config.get("username")
+            private_key_secret = config.get("private_key_secret")
+            bucket_name = config.get("bucket_name")
+            destination_blob_prefix = config.get("destination_blob_name")  # carpeta en GCS
 
-            for config in config_list:
-                print("Configuración recibida:", config)
-
-                hostname = config.get("hostname")
-                port = int(config.get("port", 22))
-                username = config.get("username")
-                private_key_secret = config.get("private_key_secret")
-                bucket_name = config.get("bucket_name")
-                destination_blob_prefix = config.get("destination_blob_name")  # carpeta en GCS
-
-                # Log de campos
-                print("hostname:", hostname)
-                print("port:", port)
-                print("username:", username)
-                print("private_key_secret:", private_key_secret)
-                print("bucket_name:", bucket_name)
-                print("destination_blob_prefix:", destination_blob_prefix)
-
-                campos_requeridos = [hostname, port, username, private_key_secret, bucket_name, destination_blob_prefix]
-                if any(c is None for c in campos_requeridos):
-                    print("❌ Configuración inválida. Faltan campos. Se omite esta entrada.")
-                    continue
+            # Log de campos
+            print("hostname:", hostname)
+            print("port:", port)
+            print("username:", username)
+            print("private_key_secret:", private_key_secret)
+            print("bucket_name:", bucket_name)
+            print("destination_blob_prefix:", destination_blob_prefix)
 
-                # Obtener clave privada
-                sm_client = secretmanager.SecretManagerServiceClient()
-                secret_name = f"projects/deinsoluciones-devops-ci-core/secrets/{private_key_secret}/versions/latest"
-                response = sm_client.access_secret_version(request={"name": secret_name})
-                private_key_data = response.payload.data.decode("UTF-8")
-
-                with tempfile.NamedTemporaryFile(delete=False, mode="w") as key_file:
-                    key_file.write(private_key_data)
-                    key_file_path = key_file.name
-
-                # Conexión SFTP
-                key = paramiko.RSAKey.from_private_key_file(key_file_path)
-                ssh = paramiko.SSHClient()
-                ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                print(f"Conectando a {hostname}:{port} como {username}")
-                ssh.connect(hostname, port=port, username=username, pkey=key)
-
-                sftp = ssh.open_sftp()
-                files = sftp.listdir_attr()
-                print("Archivos encontrados en SFTP:", [f.filename for f in files])
-
-                if not files:
-                    print("⚠️ No se encontraron archivos en el servidor SFTP.")
-                    continue
+            campos_requeridos = [hostname, port, username, private_key_secret, bucket_name, destination_blob_prefix]
+            if any(c is None for c in campos_requeridos):
+                print("❌ Configuración inválida. Faltan campos. Se omite esta entrada.")
+                continue
+
+            remote_dir = config.get("remote_dir") or "."
+            patterns = normalize_patterns(config.get("file_pattern"))
+            selection = (config.get("selection") or SELECTION_LATEST).lower()
+            mode = (config.get("transfer_mode") or TRANSFER_MODE_STREAM).lower()
+            transform = transform_options(config)
+            max_files = int(config["max_files"]) if config.get("max_files") else None
+            source_id = watermark_source_id(hostname, port, username, remote_dir, patterns)
+            watermark = load_watermark(storage_client, "sftp", source_id) if selection == SELECTION_NEW else None
+            print(f"remote_dir: {remote_dir} | patrones: {patterns} | selección: {selection}")
 
-                # Obtener el archivo más reciente
-                latest_file = max(files, key=lambda f: f.st_mtime)
-                remote_path = latest_file.filename
+            # Conexión SFTP (reutilizada desde el pool si ya está abierta y sana)
+            with sftp_connection(hostname, port, username, private_key_secret) as conexion:
+                entries, listados = list_matching_entries(conexion["sftp"], remote_dir, patterns)
+                print(f"Archivos listados en SFTP: {listados} | calzan con el patrón: {len(entries)}")
+                seleccion = select_entries(entries, selection, watermark, max_files,
+                                           backfill=_to_bool(config.get("backfill")))
 
-                temp_local_path = tempfile.NamedTemporaryFile(delete=False).name
-                sftp.get(remote_path, temp_local_path)
-                sftp.close()
-                ssh.close()
+                if not seleccion:
+                    print("⚠️ No se encontraron archivos nuevos en el servidor SFTP.")
+                    continue
 
-                # Subir a GCS
-                storage_client = storage.Client()
+                workers = resolve_max_parallel(config, len(seleccion))
+                print(f"Transfiriendo {len(seleccion)} archivo(s) con {workers} canal(es) SFTP")
                 bucket = storage_client.bucket(bucket_name)
-                full_blob_path = os.path.join(destination_blob_prefix, remote_path)
-                blob = bucket.blob(full_blob_path)
-                blob.upload_from_filename(temp_local_path)
-
-                # Limpieza
-                os.remove(key_file_path)
-                os.remove(temp_local_path)
-                archivos_subidos.append(full_blob_path)
+                destinos = [os.path.join(destination_blob_prefix, e.filename) for e in seleccion]
+                if workers == 1:
+                    resultados = [
+                        transfer_entry(conexion, remote_dir, e, bucket.blob(d), mode, transform=transform)
+                        for e, d in zip(seleccion, destinos)
+                    ]
+                else:
+                    with ThreadPoolExecutor(max_workers=workers) as executor:
+                        resultados = list(executor.map(
+                            lambda par: transfer_entry(
+                                conexion, remote_dir, par[0], bucket.blob(par[1]), mode, True, transform
+                            ),
+                            zip(seleccion, destinos),
+                        ))
+
+            for entry, full_blob_path, metricas in zip(seleccion, destinos, resultados):
+                item = {
+                    "remote_path": posixpath.join(remote_dir, entry.filename),
+                    "gcs_path": f"gs://{bucket_name}/{full_blob_path}",
+                    "mtime": entry.st_mtime,
+                    **metricas,
+                }
+                detalle.append(item)
+                if "error" in metricas:
+                    errores.append(item)
+                    continue
+                if transform:
+                    # El objeto sin transformar no se escribe: se informan las salidas reales
+                    paths = written_paths(metricas)
+                    item.update({"gcs_path": paths[0] if paths else None, "gcs_paths": paths})
+                    archivos_subidos.extend(p[len(f"gs://{bucket_name}/"):] for p in paths)
+                else:
+                    archivos_subidos.append(full_blob_path)
                 count += 1
-                print(f"✅ Archivo subido a gs://{bucket_name}/{full_blob_path}")
+                print(f"✅ Archivo subido a {item['gcs_path']} "
+                      f"({metricas['bytes']} bytes, {metricas['throughput_mb_s']} MB/s)")
+
+            if selection == SELECTION_NEW:
+                nuevo = advance_watermark(watermark, [(e, "error" not in m) for e, m in zip(seleccion, resultados)])
+                if nuevo and nuevo != {k: (watermark or {}).get(k) for k in nuevo}:
+                    save_watermark(storage_client, "sftp", source_id, nuevo)
 
-        return {
+        respuesta = {
             "message": f"Se procesaron {count} archivo(s) correctamente.",
-            "archivos": archivos_subidos
-        }, 200
+            "archivos": archivos_subidos,
+            "detalle": detalle
+        }
+        if errores:
+            respuesta["errores"] = errores
+            return respuesta, 207
+        return respuesta, 200
 
     except Exception as e:
         print("❌ Error general:", str(e))
@@ -0,0 +1,141 @@
+"""Pool de conexiones SFTP reutilizables entre entradas y entre invocaciones "warm".
+
+Las conexiones se identifican por (hostname, port, username, secret). Antes de
+entregar una conexión se valida que siga viva (transport activo + un round trip
+SFTP) y las que llevan más de SFTP_IDLE_TIMEOUT segundos sin uso se cierran.
+Las claves privadas se leen desde Secret Manager y se parsean en memoria, sin
+escribirlas a disco.
+"""
+import io
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Tuple
+
+import paramiko
+from google.cloud import secretmanager
+
+SECRET_PROJECT = "deinsoluciones-devops-ci-core"
+SFTP_IDLE_TIMEOUT = float(os.getenv("SFTP_IDLE_TIMEOUT", "300"))
+KEY_CACHE_TTL = float(os.getenv("SFTP_KEY_CACHE_TTL", "3600"))
+CONNECT_TIMEOUT = float(os.getenv("SFTP_CONNECT_TIMEOUT", "30"))
+
+PoolKey = Tuple[str, int, str, str]
+
+_lock = threading.Lock()
+_connect_lock = threading.Lock()
+_conexiones: Dict[PoolKey, dict] = {}
+_claves: Dict[str, Tuple[float, paramiko.PKey]] = {}
+_sm_client = None
+
+
+def _secret_client():
+    global _sm_client
+    if _sm_client is None:
+        _sm_client = secretmanager.SecretManagerServiceClient()
+    return _sm_client
+
+
+def get_private_key(private_key_secret: str) -> paramiko.PKey:
+    """Retorna la clave RSA del secreto, parseada en memoria y cacheada por KEY_CACHE_TTL."""
+    now = time.monotonic()
+    with _lock:
+        cached = _claves.get(private_key_secret)
+        if cached and now - cached[0] < KEY_CACHE_TTL:
+            return cached[1]
+
+    secret_name = f"projects/{SECRET_PROJECT}/secrets/{private_key_secret}/versions/latest"
+    response = _secret_client().access_secret_version(request={"name": secret_name})
+    key = paramiko.RSAKey.from_private_key(io.StringIO(response.payload.data.decode("UTF-8")))
+
+    with _lock:
+        _claves[private_key_secret] = (now, key)
+    return key
+
+
+def _cerrar(conexion: dict):
+    for recurso in (conexion.get("sftp"), conexion.get("ssh")):
+        try:
+            if recurso is not None:
+                recurso.close()
+        except Exception:
+            pass
+
+
+def _saludable(conexion: dict) -> bool:
+    transport = conexion["ssh"].get_transport()
+    if transport is None or not transport.is_active():
+        return False
+    try:
+        conexion["sftp"].normalize(".")
+        return True
+    except Exception:
+        return False
+
+
+def evict_idle():
+    """Cierra las conexiones libres sin uso por más de SFTP_IDLE_TIMEOUT segundos."""
+    now = time.monotonic()
+    with _lock:
+        vencidas = [
+            k for k, c in _conexiones.items()
+            if c["en_uso"] == 0 and now - c["last_used"] > SFTP_IDLE_TIMEOUT
+        ]
+        cerrar = [_conexiones.pop(k) for k in vencidas]
+    for conexion in cerrar:
+        _cerrar(conexion)
+
+
+def _conectar(hostname: str, port: int, username: str, private_key_secret: str) -> dict:
+    key = get_private_key(private_key_secret)
+    ssh = paramiko.SSHClient()
+    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    print(f"Conectando a {hostname}:{port} como {username}")
+    ssh.connect(hostname, port=port, username=username, pkey=key,
+                timeout=CONNECT_TIMEOUT, banner_timeout=CONNECT_TIMEOUT, auth_timeout=CONNECT_TIMEOUT)
+    return {"ssh": ssh, "sftp": ssh.open_sftp(), "last_used": time.monotonic(), "en_uso": 0}
+
+
+def _obtener(key: PoolKey) -> dict:
+    # Las aperturas se serializan para no abrir dos conexiones para la misma llave
+    with _connect_lock:
+        with _lock:
+            conexion = _conexiones.get(key)
+        if conexion is not None and conexion["en_uso"] == 0 and not _saludable(conexion):
+            with _lock:
+                _conexiones.pop(key, None)
+            _cerrar(conexion)
+            conexion = None
+        if conexion is None:
+            conexion = _conectar(*key)
+        else:
+            print(f"♻️ Reutilizando conexión SFTP a {key[0]}:{key[1]} como {key[2]}")
+        with _lock:
+            _conexiones[key] = conexion
+            conexion["en_uso"] += 1
+            conexion["last_used"] = time.monotonic()
+    return conexion
+
+
+@contextmanager
+def sftp_connection(hostname: str, port: int, username: str, private_key_secret: str):
+    """Entrega una conexión {"ssh", "sftp"} del pool y la devuelve al salir.
+
+    Si el bloque falla, la conexión se descarta para que la siguiente entrada abra una nueva.
+    """
+    evict_idle()
+    key: PoolKey = (hostname, port, username, private_key_secret)
+    conexion = _obtener(key)
+    try:
+        yield conexion
+    except Exception:
+        with _lock:
+            if _conexiones.get(key) is conexion:
+                _conexiones.pop(key)
+        _cerrar(conexion)
+        raise
+    finally:
+        with _lock:
+            conexion["en_uso"] -= 1
+            conexion["last_used"] = time.monotonic()
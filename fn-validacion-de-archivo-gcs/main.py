@@ -1,33 +1,116 @@
 import functions_framework
 import json
+import pyarrow as pa
 import pyarrow.parquet as pq
-from google.cloud import storage, bigquery
+import struct
+from google.cloud import storage
 from io import BytesIO
 from datetime import datetime, timezone, timedelta
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from config_resolver import resolve_params
 
 DEFAULT_BUCKET = "dev-deinsoluciones-ingestas"
 
-def check_parquet_records(bucket_name, file_name):
-    """Verifica si un archivo Parquet en Cloud Storage tiene registros."""
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(file_name)
+VALIDATION_MODE_FOOTER = "footer"
+VALIDATION_MODE_FULL = "full"
+PARQUET_MAGIC = b"PAR1"
+# Bytes leídos desde el final del archivo en el primer intento de leer el footer
+FOOTER_READ_SIZE = int(os.getenv("PARQUET_FOOTER_READ_SIZE", str(64 * 1024)))
+# Concurrencia para listar y validar; el pool HTTP del cliente GCS es de 10 conexiones
+DEFAULT_MAX_WORKERS = int(os.getenv("VALIDATION_MAX_WORKERS", "8"))
+MAX_WORKERS_LIMIT = 10
+
+def read_parquet_footer(blob):
+    """Lee solo el footer de un Parquet con lecturas por rango (no descarga datos de columnas)."""
+    size = blob.size
+    if size is None or size < 12:
+        raise ValueError(f"Archivo demasiado pequeño para ser Parquet ({size} bytes)")
+
+    # Lectura especulativa del final del archivo: casi siempre incluye el footer completo
+    tail = blob.download_as_bytes(start=max(0, size - FOOTER_READ_SIZE), end=size - 1, checksum=None)
+    if tail[-4:] != PARQUET_MAGIC:
+        raise ValueError("El archivo no termina con la firma PAR1 (no es Parquet válido)")
+
+    footer_len = struct.unpack("<I", tail[-8:-4])[0]
+    if footer_len + 8 > size:
+        raise ValueError(f"Largo de footer inválido ({footer_len} bytes)")
+    if footer_len + 8 > len(tail):
+        tail = blob.download_as_bytes(start=size - footer_len - 8, end=size - 1, checksum=None)
+
+    return pq.read_metadata(pa.BufferReader(tail[-(footer_len + 8):]))
+
+def check_parquet_blob(blob, mode=VALIDATION_MODE_FOOTER):
+    """Verifica si un blob Parquet (con metadata ya cargada) tiene registros.
+
+    mode="footer" lee solo la metadata del archivo; mode="full" descarga y lee la tabla completa.
+    """
+    result = {"exists": True, "size_bytes": blob.size, "validation_mode": mode}
+    try:
+        if mode == VALIDATION_MODE_FULL:
+            file_stream = BytesIO()
+            blob.download_to_file(file_stream)
+            file_stream.seek(0)
+            table = pq.read_table(file_stream)
+            result["num_rows"] = table.num_rows
+        else:
+            metadata = read_parquet_footer(blob)
+            result["num_rows"] = metadata.num_rows
+            result["num_row_groups"] = metadata.num_row_groups
+            result["columns"] = metadata.schema.to_arrow_schema().names
+    except Exception as e:
+        result.update({"has_records": False, "error": str(e)})
+        return result
 
-    if not blob.exists():
-        return {"exists": False, "has_records": False}
+    result["has_records"] = result["num_rows"] > 0
+    return result
 
-    file_stream = BytesIO()
-    blob.download_to_file(file_stream)
-    file_stream.seek(0)
+def check_parquet_records(bucket_name, file_name, mode=VALIDATION_MODE_FOOTER, storage_client=None):
+    """Verifica si un archivo Parquet en Cloud Storage tiene registros."""
+    storage_client = storage_client or storage.Client()
+    blob = storage_client.bucket(bucket_name).get_blob(file_name)
 
+    if blob is None:
+        return {"exists": False, "has_records": False}
+    return check_parquet_blob(blob, mode)
+
+def _list_recent_parquet(storage_client, bucket_name, path_name, now, delta):
+    """Lista los .parquet de un path modificados dentro de la ventana `delta`."""
+    start = time.monotonic()
+    blobs = storage_client.list_blobs(bucket_name, prefix=path_name + "/")
+    candidatos = [
+        blob for blob in blobs
+        if blob.name.endswith(".parquet") and (now - blob.updated) <= delta
+    ]
+    return candidatos, int((time.monotonic() - start) * 1000)
+
+def _validate_blob(blob, periodicidad, mode):
+    start = time.monotonic()
+    result = check_parquet_blob(blob, mode)
+    result["archivo"] = f"gs://{blob.bucket.name}/{blob.name}"
+    result["periodicidad"] = periodicidad
+    result["duration_ms"] = int((time.monotonic() - start) * 1000)
+    return result
+
+def _resolve_max_workers(value):
     try:
-        table = pq.read_table(file_stream)
-        has_records = len(table) > 0
-    except Exception as e:
-        return {"exists": True, "has_records": False, "error": str(e)}
-
-    return {"exists": True, "has_records": has_records}
+        n = int(value)
+    except (TypeError, ValueError):
+        n = DEFAULT_MAX_WORKERS
+    return max(1, min(n, MAX_WORKERS_LIMIT))
+
+def _path_summary(path_name, list_ms, resultados):
+    slowest = max(resultados, key=lambda r: r["duration_ms"], default=None)
+    return {
+        "path": path_name,
+        "files": len(resultados),
+        "total_rows": sum(r.get("num_rows", 0) for r in resultados),
+        "total_bytes": sum(r.get("size_bytes") or 0 for r in resultados),
+        "list_duration_ms": list_ms,
+        "slowest_file": {"archivo": slowest["archivo"], "duration_ms": slowest["duration_ms"]} if slowest else None,
+    }
 
 @functions_framework.http
 def validate_parquet(request):
@@ -37,71 +120,63 @@ def validate_parquet(request):
     process_name = request_json.get("process_name")
     process_fn_name = request_json.get("process_fn_name")
     arquetype_name = request_json.get("arquetype_name")
+    validation_mode = (request_json.get("validation_mode") or VALIDATION_MODE_FOOTER).lower()
+    max_workers = _resolve_max_workers(request_json.get("max_workers", DEFAULT_MAX_WORKERS))
 
     if not process_name or not process_fn_name:
         return json.dumps({"error": "Faltan 'process_name' ,  'process_fn_name' O 'arquetype_name'"}), 400
 
-    # Consultar parámetros desde BigQuery
-    bq = bigquery.Client()
-    query = """
-        SELECT params
-        FROM `deinsoluciones-serverless.dev_config_zone.process_params`
-        WHERE process_name = @process_name
-        AND process_fn_name = @process_fn_name
-        AND arquetype_name = @arquetype_name
-        AND active = TRUE
+    if validation_mode not in (VALIDATION_MODE_FOOTER, VALIDATION_MODE_FULL):
+        return json.dumps({"error": "validation_mode debe ser 'footer' o 'full'"}), 400
 
-    """
-    job_config = bigquery.QueryJobConfig(
-        query_parameters=[
-            bigquery.ScalarQueryParameter("process_name", "STRING", process_name),
-            bigquery.ScalarQueryParameter("process_fn_name", "STRING", process_fn_name),
-            bigquery.ScalarQueryParameter("arquetype_name", "STRING", arquetype_name)
-        ]
-    )
-    results = list(bq.query(query, job_config=job_config).result())
-    if not results:
+    # Consultar parámetros desde BigQuery (con caché por instancia)
+    params = resolve_params(process_name, process_fn_name, arquetype_name)
+    if not params:
         return json.dumps({"error": "Parámetros no encontrados para el proceso"}), 404
 
-    params = results[0]["params"]
     bucket_name = DEFAULT_BUCKET
 
-    # Revisar últimos archivos actualizados por cada path
+    # Un solo cliente compartido por todos los hilos
     storage_client = storage.Client()
     now = datetime.now(timezone.utc)
     delta = timedelta(minutes=10)  # Considera archivos modificados en los últimos 10 minutos
-    archivos_recientes = []
-
-    for p in params:
-        path_name = p["path_name"].rstrip("/")
-        periodicidad = p.get("periodicidad", "esporádica").lower()
 
-        blobs = list(storage_client.list_blobs(bucket_name, prefix=path_name + "/"))
-        candidatos = [
-            blob for blob in blobs
-            if blob.name.endswith(".parquet") and (now - blob.updated) <= delta
+    paths = [(p["path_name"].rstrip("/"), p.get("periodicidad", "esporádica").lower()) for p in params]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # Revisar últimos archivos actualizados por cada path (en paralelo)
+        listados = list(executor.map(
+            lambda path: _list_recent_parquet(storage_client, bucket_name, path[0], now, delta),
+            paths,
+        ))
+
+        for (path_name, _), (candidatos, _) in zip(paths, listados):
+            if not candidatos:
+                return json.dumps({
+                    "path": path_name,
+                    "exists": False,
+                    "has_records": False,
+                    "error": "No se encontraron archivos recientes .parquet"
+                }), 404
+
+        # Validar archivos (en paralelo)
+        futures = [
+            [executor.submit(_validate_blob, blob, periodicidad, validation_mode) for blob in candidatos]
+            for (_, periodicidad), (candidatos, _) in zip(paths, listados)
         ]
+        resultados_por_path = [[f.result() for f in path_futures] for path_futures in futures]
 
-        if not candidatos:
-            return json.dumps({
-                "path": path_name,
-                "exists": False,
-                "has_records": False,
-                "error": "No se encontraron archivos recientes .parquet"
-            }), 404
-
-        archivos_recientes.extend([(blob.name, periodicidad) for blob in candidatos])
-
-    # Validar archivos
-    resultados = []
-    for nombre_archivo, periodicidad in archivos_recientes:
-        result = check_parquet_records(bucket_name, nombre_archivo)
-        result["archivo"] = f"gs://{bucket_name}/{nombre_archivo}"
-        result["periodicidad"] = periodicidad
-        resultados.append(result)
+    resultados = [r for path_resultados in resultados_por_path for r in path_resultados]
+    resumen = [
+        _path_summary(path_name, list_ms, path_resultados)
+        for (path_name, _), (_, list_ms), path_resultados in zip(paths, listados, resultados_por_path)
+    ]
 
     return json.dumps({
         "bucket": bucket_name,
+        "validation_mode": validation_mode,
+        "max_workers": max_workers,
         "procesados": len(resultados),
+        "paths": resumen,
         "archivos": resultados
     }), 200